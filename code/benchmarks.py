@@ -0,0 +1,168 @@
+# general import
+import os
+import re
+import sys
+import time
+from collections import defaultdict
+
+XML_FIXTURES = os.path.join("pmc_cache", "xml")
+TEXT_FOLDER = "text_folder"
+
+
+def best_time(func, *args, repeat=3):
+    """
+    Run a function several times and keep the fastest run
+
+    @params:
+        - func: the function to time
+        - args: its arguments
+        - repeat: number of runs
+
+    @returns:
+        - a (seconds, result) tuple
+    """
+    best, result = float("inf"), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def report(name, legacy_time, new_time, same_output):
+    speedup = legacy_time / new_time if new_time else float("inf")
+    print(f"{name:<40} legacy {legacy_time:8.3f}s | new {new_time:8.3f}s | x{speedup:5.2f} | same output: {same_output}")
+
+def load_xml_fixtures(fixtures_folder=XML_FIXTURES):
+    """
+    Read saved article XML files, by default the harvester cache of pubmed_full_text
+    """
+    fixtures = []
+    for folder, _, filenames in os.walk(fixtures_folder):
+        for filename in sorted(filenames):
+            if filename.endswith(".xml"):
+                with open(os.path.join(folder, filename), "r", encoding="utf-8") as f:
+                    fixtures.append(f.read())
+    return fixtures
+
+def benchmark_pmc_parser(fixtures_folder=XML_FIXTURES, repeat=3):
+    """
+    Compare the tree-based extract_metadata_and_paragraphs with the iterparse-based parser,
+    article by article and on a whole <pmc-articleset> like a batched efetch response
+    """
+    from pubmed_full_text import extract_metadata_and_paragraphs, parse_article, iter_parse_articles, split_article_set
+
+    fixtures = load_xml_fixtures(fixtures_folder)
+    if not fixtures:
+        print(f"No XML fixtures found in {fixtures_folder}")
+        return
+    print(f"{len(fixtures)} XML fixtures")
+
+    def legacy_articles():
+        return [extract_metadata_and_paragraphs(xml, i) for i, xml in enumerate(fixtures, 1)]
+
+    def new_articles():
+        return [parse_article(xml, i) for i, xml in enumerate(fixtures, 1)]
+
+    legacy_time, legacy_result = best_time(legacy_articles, repeat=repeat)
+    new_time, new_result = best_time(new_articles, repeat=repeat)
+    report("per article", legacy_time, new_time, legacy_result == new_result)
+
+    article_set = "<pmc-articleset>" + "".join(fixtures) + "</pmc-articleset>"
+
+    def legacy_batch():
+        results = (extract_metadata_and_paragraphs(xml, 0) for _, xml in split_article_set(article_set))
+        return [[chunk["text"] for chunk in result[1]] if result else [] for result in results]
+
+    def new_batch():
+        return [content for _, _, content in iter_parse_articles(article_set)]
+
+    legacy_time, legacy_result = best_time(legacy_batch, repeat=repeat)
+    new_time, new_result = best_time(new_batch, repeat=repeat)
+    report("batched <pmc-articleset>", legacy_time, new_time, legacy_result == new_result)
+
+
+# Reference implementations of the chunking hot path, as they were before the set-based rework
+
+def legacy_detect_headers(text):
+    header_pattern = re.compile(
+        r'^(?:\d+[\.\s]*)?'
+        r'([A-Z][A-Z0-9\s\-]*[A-Z])$'
+        r'|^([A-Z][a-z]+(?:\s[A-Z][a-z]+)*)$'
+        r'|^(\b[A-Z][a-z]+\b)$'
+    )
+    headers = []
+    for line in text.split("\n"):
+        match = header_pattern.match(line.strip())
+        if match:
+            headers.append(next(group for group in match.groups() if group))
+    return headers
+
+def legacy_normalize_header(header):
+    header = re.sub(r'^\d+[\.\s]*', '', header)
+    return header.strip().upper()
+
+def legacy_chunk_text(text):
+    headers = [legacy_normalize_header(h) for h in legacy_detect_headers(text)]
+    sections = []
+    current_section = ""
+    for line in text.split("\n"):
+        if legacy_normalize_header(line) in headers:
+            if current_section:
+                sections.append(current_section.strip())
+            current_section = line + "\n"
+        else:
+            current_section += line + "\n"
+    if current_section:
+        sections.append(current_section.strip())
+    if len(sections) <= 1:
+        paragraphs = re.split(r"\n\s*\n", text)
+        return [p.strip() for p in paragraphs if p.strip()]
+    return sections
+
+def legacy_filter_species(data):
+    keywords = ["albopictus", "aegypti"]
+    regex_pattern = '|'.join([''.join([f'{char}[\\W_]*' for char in word]) for word in keywords])
+    return [item for item in data if re.search(regex_pattern, item.get("text", "").lower())]
+
+def legacy_combine_chunks(chunks):
+    combined = defaultdict(str)
+    for item in chunks:
+        combined[item['source_type']] += item['text']
+    return [{'source_type': doc_id, 'text': text} for doc_id, text in combined.items()]
+
+def benchmark_chunking(text_folder=TEXT_FOLDER, repeat=3):
+    """
+    Compare chunk_text, filter_species and combine_chunks with their reference implementations
+    on the text files produced by process_pdfs
+    """
+    from text_proccessor_utilities import read_text_files_from_folder, chunk_text, filter_species, combine_chunks
+
+    if not os.path.isdir(text_folder):
+        print(f"Text folder {text_folder} not found")
+        return
+    texts = read_text_files_from_folder(text_folder)
+    print(f"{len(texts)} text files, {sum(map(len, texts.values()))} characters")
+
+    def chunk_all(chunker):
+        return [{"source_type": os.path.splitext(filename)[0], "text": segment}
+                for filename, content in texts.items() for segment in chunker(content)]
+
+    legacy_time, legacy_chunks = best_time(chunk_all, legacy_chunk_text, repeat=repeat)
+    new_time, chunks = best_time(chunk_all, chunk_text, repeat=repeat)
+    report("chunk_text", legacy_time, new_time, legacy_chunks == chunks)
+
+    legacy_time, legacy_result = best_time(legacy_filter_species, chunks, repeat=repeat)
+    new_time, result = best_time(lambda data: list(filter_species(data)), chunks, repeat=repeat)
+    report("filter_species", legacy_time, new_time, legacy_result == result)
+
+    legacy_time, legacy_result = best_time(legacy_combine_chunks, chunks, repeat=repeat)
+    new_time, result = best_time(lambda data: list(combine_chunks(data)), chunks, repeat=repeat)
+    report("combine_chunks", legacy_time, new_time, legacy_result == result)
+
+
+if __name__ == "__main__":
+    benchmarks = {"pmc_parser": benchmark_pmc_parser, "chunking": benchmark_chunking}
+    if len(sys.argv) < 2 or sys.argv[1] not in benchmarks:
+        print(f"usage: python benchmarks.py {{{','.join(benchmarks)}}} [input_folder]")
+        sys.exit(1)
+    benchmarks[sys.argv[1]](*sys.argv[2:3])
@@ -0,0 +1,208 @@
+# general import
+import json
+import torch
+from transformers import LogitsProcessor
+
+VECTORS = ["Aedes aegypti", "Aedes albopictus"]
+MAX_FIELD_LENGTH = 200      # characters of a free text field
+MAX_YEAR_DIGITS = 4
+MAX_CANDIDATES = 256        # tokens tried, by decreasing score, before stopping the generation
+DECODE_CONTEXT = 4          # previous tokens decoded with a new one, for sentencepiece spaces and multi-byte characters
+
+# Occurrence schema, with a fixed key order and formatting so that the generated JSON is as short as possible
+LITERAL, ENUM, STRING, INTEGER = "literal", "enum", "string", "integer"
+OBJECT_PARTS = [
+    (LITERAL, '{"vector": "'), (ENUM, VECTORS),
+    (LITERAL, '", "location": "'), (STRING, None),
+    (LITERAL, '", "country": "'), (STRING, None),
+    (LITERAL, '", "date": "'), (STRING, None),
+    (LITERAL, '", "year": '), (INTEGER, None),
+    (LITERAL, '}'),
+]
+SEPARATOR = ", "
+
+# states outside of an object, an object state is a (part index, text of the part so far) tuple
+START, OPEN, FIRST, AFTER, END = "start", "open", "first", "after", "end"
+
+
+def can_end(part, typed):
+    """
+    Whether the value typed so far is a complete value of the part
+    """
+    kind, value = part
+    if kind == LITERAL:
+        return typed == value
+    if kind == ENUM:
+        return typed in value
+    return len(typed) > 0
+
+def extend(part, typed, char):
+    """
+    Whether char can be appended to the value of the part
+    """
+    kind, value = part
+    if kind == LITERAL:
+        return len(typed) < len(value) and value[len(typed)] == char
+    if kind == ENUM:
+        return any(option.startswith(typed + char) for option in value)
+    if kind == STRING:
+        return len(typed) < MAX_FIELD_LENGTH and char not in '"\\\n' and char.isprintable()
+    return len(typed) < MAX_YEAR_DIGITS and char.isdigit() and (typed or char != "0")
+
+def step(state, char):
+    """
+    Advance the occurrence array grammar by one character
+
+    @params:
+        - state: the current state
+        - char: the next character
+
+    @returns:
+        - the new state, or None if the character is not allowed
+    """
+    if state in (START, OPEN):
+        if char == "[":
+            return FIRST
+        # a single whitespace is allowed after the prompt
+        return OPEN if state == START and char in " \n" else None
+    if state == FIRST:
+        if char == "]":
+            return END
+        return step((0, ""), char)
+    if state == AFTER:
+        if char == "]":
+            return END
+        if char == SEPARATOR[0]:
+            return ("separator", char)
+        return None
+    if state == END:
+        return None
+    if state[0] == "separator":
+        if len(state[1]) < len(SEPARATOR):
+            return ("separator", state[1] + char) if SEPARATOR[len(state[1])] == char else None
+        return step((0, ""), char)
+
+    index, typed = state
+    part = OBJECT_PARTS[index]
+    if extend(part, typed, char):
+        typed += char
+        if part[0] == LITERAL and typed == part[1]:
+            return AFTER if index == len(OBJECT_PARTS) - 1 else (index + 1, "")
+        return index, typed
+    if part[0] != LITERAL and can_end(part, typed):
+        # a value part ends where the next literal starts
+        return step((index + 1, ""), char)
+    return None
+
+def run(state, text):
+    """
+    Advance the grammar over a text, None if the text is not allowed
+    """
+    for char in text:
+        state = step(state, char)
+        if state is None:
+            return None
+    return state
+
+
+class OccurrenceJSONProcessor(LogitsProcessor):
+    """
+    Logits processor that only lets the model write a JSON array of occurrences following OBJECT_PARTS.
+    At each step the candidate tokens are tried by decreasing score and the best one that keeps the output
+    valid is the only one left, so decoding is greedy. Tokens are checked on the decoded text rather than on
+    the vocabulary so that byte-level and sentencepiece tokenizers are handled the same way.
+    Only the text added by a token is decoded, with the DECODE_CONTEXT tokens before it, so a step costs the
+    same whatever the length of the output. A new processor must be created for each generate call.
+    """
+
+    def __init__(self, tokenizer, max_candidates=MAX_CANDIDATES):
+        self.tokenizer = tokenizer
+        self.max_candidates = max_candidates
+        self.prompt_length = None
+        self.states = None
+
+    def __call__(self, input_ids, scores):
+        if self.prompt_length is None:
+            self.prompt_length = input_ids.shape[1]
+            self.states = [START] * input_ids.shape[0]
+
+        constrained = torch.full_like(scores, float("-inf"))
+        for row, generated in enumerate(input_ids[:, self.prompt_length:].tolist()):
+            self.states[row] = self.advance(self.states[row], generated)
+            constrained[row, self.choose(self.states[row], generated, scores[row])] = 0
+        return constrained
+
+    def decode(self, ids):
+        return self.tokenizer.decode(ids, skip_special_tokens=True)
+
+    def added_text(self, context_text, context, token_ids):
+        """
+        Text added by token_ids after the context tokens (whose decoded text is context_text),
+        None if the decoded texts do not line up, e.g. when the context ends inside a multi-byte character
+        """
+        new_text = self.decode(context + token_ids)
+        if not new_text.startswith(context_text):
+            return None
+        return new_text[len(context_text):]
+
+    def advance(self, state, generated):
+        """
+        Update the grammar state of a row with its last generated token
+        """
+        if state is None or not generated:
+            return state
+        context = generated[-1 - DECODE_CONTEXT:-1]
+        added = self.added_text(self.decode(context), context, generated[-1:])
+        if added is None:
+            # the previous text ended inside a multi-byte character
+            return run(START, self.decode(generated))
+        return run(state, added)
+
+    def choose(self, state, generated, row_scores):
+        """
+        Best scoring token that keeps the output valid, the end of sequence token once the array is closed
+        """
+        eos_token_id = self.tokenizer.eos_token_id
+        if state == END or state is None:
+            return eos_token_id
+        context = generated[-DECODE_CONTEXT:]
+        context_text = self.decode(context)
+        candidates = torch.topk(row_scores, min(self.max_candidates, row_scores.shape[-1])).indices.tolist()
+        for token_id in candidates:
+            if token_id == eos_token_id:
+                continue
+            added = self.added_text(context_text, context, [token_id])
+            if added == "":
+                continue
+            if added is not None:
+                valid = run(state, added) is not None
+            else:
+                valid = run(START, self.decode(generated + [token_id])) is not None
+            if valid:
+                return token_id
+        # no valid continuation among the best candidates, the output is closed by parse_occurrences
+        return eos_token_id
+
+
+def parse_occurrences(text):
+    """
+    Parse the output of a constrained generation.
+    An array cut by max_new_tokens is truncated after its last complete object.
+
+    @params:
+        - text: the generated text
+
+    @returns:
+        - list of occurrence dictionaries
+    """
+    text = text.strip()
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        end = text.rfind("}")
+        if end < 0:
+            return []
+        try:
+            return json.loads(text[:end + 1] + "]")
+        except json.JSONDecodeError:
+            return []
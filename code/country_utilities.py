@@ -0,0 +1,139 @@
+# general import
+import json
+import logging
+import os
+import country_converter as coco
+import pycountry_convert as pc
+
+COUNTRY_CACHE = "country_cache.json"
+NOT_FOUND = "not found"
+CONTINENTS = {
+    'AF': 'Africa',
+    'AS': 'Asia',
+    'EU': 'Europe',
+    'NA': 'North America',
+    'SA': 'South America',
+    'OC': 'Oceania',
+    'AN': 'Antarctica'
+}
+UNKNOWN_CONTINENT = 'Unknown'
+
+_converter = None
+
+
+def get_converter():
+    # building the converter reads its whole country table, it is done once
+    global _converter
+    if _converter is None:
+        _converter = coco.CountryConverter()
+    return _converter
+
+def normalize_country_name(name):
+    return " ".join(str(name).split()).casefold()
+
+def continent_of(iso2, fallback):
+    """
+    Continent name from the ISO2 code, fallback (country_converter's continent_7) for the codes pycountry_convert lacks
+    """
+    try:
+        return CONTINENTS[pc.country_alpha2_to_continent_code(iso2)]
+    except KeyError:
+        return fallback if fallback != NOT_FOUND else UNKNOWN_CONTINENT
+
+def convert_names(names):
+    """
+    Resolve country names with one country_converter call per target instead of one call per name
+
+    @params:
+        - names: list of distinct country names
+
+    @returns:
+        - a dictionary name -> {"iso2", "name_official", "continent"}, None for unknown names
+    """
+    converter = get_converter()
+    # country_converter logs every unknown name, they are reported together by resolve_countries
+    logger = logging.getLogger("country_converter.country_converter")
+    level = logger.level
+    logger.setLevel(logging.ERROR)
+    try:
+        columns = [converter.convert(names=names, to=target, not_found=NOT_FOUND) for target in ("ISO2", "name_official", "continent_7")]
+    finally:
+        logger.setLevel(level)
+    # a single name gives a string instead of a list
+    columns = [column if isinstance(column, list) else [column] for column in columns]
+
+    resolved = {}
+    for name, iso2, official, continent in zip(names, *columns):
+        if not isinstance(iso2, str) or iso2 == NOT_FOUND:
+            resolved[name] = None
+        else:
+            resolved[name] = {"iso2": iso2, "name_official": official, "continent": continent_of(iso2, continent)}
+    return resolved
+
+def load_country_cache(path=COUNTRY_CACHE):
+    if path and os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    return {}
+
+def save_country_cache(cache, path=COUNTRY_CACHE):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(cache, f, ensure_ascii=False, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def resolve_countries(names, cache_path=COUNTRY_CACHE):
+    """
+    Mapping table of country names: each distinct normalized name is resolved once and kept in a JSON cache
+    across runs, unknown names included. The unknown names are reported in one message.
+
+    @params:
+        - names: iterable of country names, with duplicates
+        - cache_path: path of the JSON cache, no cache if None
+
+    @returns:
+        - a dictionary normalized name -> {"iso2", "name_official", "continent"}, None for unknown names
+    """
+    cache = load_country_cache(cache_path)
+    keys = {normalize_country_name(name) for name in names if isinstance(name, str) and name.strip()}
+    missing = sorted(keys - cache.keys())
+    if missing:
+        cache.update(convert_names(missing))
+        if cache_path:
+            save_country_cache(cache, cache_path)
+    unknown = sorted(key for key in keys if cache[key] is None)
+    if unknown:
+        print(f"{len(unknown)} unknown country names: {', '.join(unknown)}")
+    return {key: cache[key] for key in keys}
+
+def map_countries(series, field, default=None, cache_path=COUNTRY_CACHE):
+    """
+    Map a column of country names to one field of the mapping table, resolving only its unique values
+
+    @params:
+        - series: the country column
+        - field: "iso2", "name_official" or "continent"
+        - default: value of the unknown names
+        - cache_path: path of the JSON cache
+
+    @returns:
+        - a Series aligned with series
+    """
+    table = resolve_countries(series.dropna().unique(), cache_path)
+    lookup = {}
+    for value in series.dropna().unique():
+        entry = table.get(normalize_country_name(value)) if isinstance(value, str) else None
+        lookup[value] = entry[field] if entry else default
+    return series.map(lookup).where(series.notna(), default)
+
+def is_valid_country_column(series, cache_path=COUNTRY_CACHE):
+    """
+    Boolean Series: whether each name is a known country
+    """
+    return map_countries(series, "iso2", cache_path=cache_path).notna()
+
+def continent_column(series, cache_path=COUNTRY_CACHE):
+    """
+    Continent of each country name, 'Unknown' for the unknown names
+    """
+    return map_countries(series, "continent", default=UNKNOWN_CONTINENT, cache_path=cache_path)
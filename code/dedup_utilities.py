@@ -0,0 +1,146 @@
+# general import
+import hashlib
+import re
+import zlib
+import numpy as np
+import pandas as pd
+
+SHINGLE_WORDS = 5       # a chunk is the set of its 5 word shingles
+NUM_PERM = 128          # MinHash signature length
+BANDS = 16              # LSH bands of NUM_PERM / BANDS rows, pairs above ~0.7 Jaccard become candidates
+THRESHOLD = 0.8         # estimated Jaccard similarity above which a chunk is a near duplicate
+CHARS_PER_TOKEN = 4     # token estimate when no tokenizer is given
+PROVENANCE_FILE = "dedup_provenance.jsonl"
+MERSENNE_PRIME = (1 << 31) - 1
+WORD_PATTERN = re.compile(r"\w+")
+
+# fixed seed, signatures are comparable across runs
+_rng = np.random.default_rng(0)
+PERM_A = _rng.integers(1, MERSENNE_PRIME, NUM_PERM, dtype=np.uint64)
+PERM_B = _rng.integers(0, MERSENNE_PRIME, NUM_PERM, dtype=np.uint64)
+
+
+def normalize_words(text):
+    return WORD_PATTERN.findall(text.lower())
+
+def minhash_signature(words, shingle_words=SHINGLE_WORDS):
+    """
+    MinHash signature of the word shingles of a text, a text shorter than a shingle is a single shingle
+
+    @params:
+        - words: the normalized words of the text
+        - shingle_words: number of words of a shingle
+
+    @returns:
+        - an array of NUM_PERM integers
+    """
+    k = min(shingle_words, len(words))
+    shingles = {zlib.crc32(" ".join(words[i:i + k]).encode("utf-8")) for i in range(len(words) - k + 1)}
+    hashes = np.fromiter(shingles, dtype=np.uint64, count=len(shingles)) % MERSENNE_PRIME
+    # (a * h + b) mod p with a, h < 2^31 stays below 2^63
+    return ((hashes[:, None] * PERM_A + PERM_B) % MERSENNE_PRIME).min(axis=0).astype(np.uint32)
+
+def count_tokens(text, tokenizer=None):
+    if tokenizer is None:
+        return len(text) // CHARS_PER_TOKEN
+    return len(tokenizer(text, add_special_tokens=False)["input_ids"])
+
+def dedupe_chunks(chunks, threshold=THRESHOLD, bands=BANDS, provenance=None, stats=None, tokenizer=None):
+    """
+    Drop the exact and near duplicate chunks of the whole corpus, the first occurrence of a text is kept.
+    Exact duplicates are found on the normalized words, near duplicates with MinHash signatures
+    indexed by LSH bands, candidates being confirmed on their estimated Jaccard similarity.
+    Chunks are yielded in their input order.
+
+    @params:
+        - chunks: iterable of chunks with source_type and text
+        - threshold: estimated Jaccard similarity above which a chunk is dropped
+        - bands: number of LSH bands, NUM_PERM must be a multiple of it
+        - provenance: optional list filled with one record per dropped chunk: its source_type and text, the source_type
+          of the kept chunk (duplicate_of) and the similarity, see credit_duplicates
+        - stats: optional dictionary filled with the number of chunks kept and dropped and the tokens saved
+        - tokenizer: tokenizer of the extraction model, tokens are estimated from the characters if None
+    """
+    if stats is None:
+        stats = {}
+    for key in ("chunks", "exact", "near", "tokens_saved"):
+        stats.setdefault(key, 0)
+    rows = NUM_PERM // bands
+    exact = {}                                      # hash of the normalized text -> source_type of the kept chunk
+    buckets = [dict() for _ in range(bands)]        # band -> band values -> ids of the kept chunks
+    signatures, sources = [], []                    # signature and source_type of each kept chunk
+
+    for chunk in chunks:
+        stats["chunks"] += 1
+        words = normalize_words(chunk["text"])
+        if not words:
+            yield chunk
+            continue
+        digest = hashlib.sha1(" ".join(words).encode("utf-8")).digest()
+        duplicate_of, similarity, kind = exact.get(digest), 1.0, "exact"
+        if duplicate_of is None:
+            signature = minhash_signature(words)
+            keys = [signature[band * rows:(band + 1) * rows].tobytes() for band in range(bands)]
+            candidates = {idx for band, key in enumerate(keys) for idx in buckets[band].get(key, ())}
+            if candidates:
+                candidates = sorted(candidates)
+                similarities = (np.stack([signatures[idx] for idx in candidates]) == signature).mean(axis=1)
+                best = int(similarities.argmax())
+                if similarities[best] >= threshold:
+                    duplicate_of, similarity, kind = sources[candidates[best]], float(similarities[best]), "near"
+
+        if duplicate_of is None:
+            exact[digest] = chunk["source_type"]
+            for band, key in enumerate(keys):
+                buckets[band].setdefault(key, []).append(len(signatures))
+            signatures.append(signature)
+            sources.append(chunk["source_type"])
+            yield chunk
+            continue
+
+        stats[kind] += 1
+        stats["tokens_saved"] += count_tokens(chunk["text"], tokenizer)
+        if provenance is not None:
+            provenance.append({"source_type": chunk["source_type"], "duplicate_of": duplicate_of,
+                               "similarity": round(similarity, 3), "text": chunk["text"]})
+
+    dropped = stats["exact"] + stats["near"]
+    estimate = "" if tokenizer is not None else " (estimated)"
+    print(f"Deduplication: {stats['chunks']} chunks, {stats['exact']} exact and {stats['near']} near duplicates dropped "
+          f"-> {stats['tokens_saved']} input tokens{estimate} not sent to the LLM for {dropped} chunks")
+
+def mentions(text, location, country):
+    # any part of the "[Locality], [Region], [Country]" location, or the country, in the lower case text
+    parts = (part.strip() for part in [*str(location).lower().split(","), str(country).lower()])
+    return any(len(part) >= 3 and part in text for part in parts)
+
+def credit_duplicates(df, provenance):
+    """
+    Credit the documents whose chunks were dropped as duplicates: an occurrence extracted from the kept document
+    is copied to the document of a dropped chunk when its location or country is mentioned in the dropped text
+
+    @params:
+        - df: occurrences with source_type, location and country columns
+        - provenance: records written by dedupe_chunks
+
+    @returns:
+        - df with the credited rows appended
+    """
+    if not provenance:
+        return df
+    key = df["source_type"].astype(str)
+    credited = []
+    for record in provenance:
+        if str(record["source_type"]) == str(record["duplicate_of"]):
+            continue
+        rows = df[key == str(record["duplicate_of"])]
+        if rows.empty:
+            continue
+        text = record["text"].lower()
+        rows = rows[[mentions(text, location, country) for location, country in zip(rows["location"], rows["country"])]]
+        if not rows.empty:
+            source_type = pd.Series(record["source_type"], index=rows.index).astype(df["source_type"].dtype)
+            credited.append(rows.assign(source_type=source_type))
+    if not credited:
+        return df
+    return pd.concat([df, *credited]).drop_duplicates()
@@ -0,0 +1,132 @@
+# general import
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+TOLERANCE = 0.2     # degrees, on both latitude and longitude
+GROUP_SPACING = 1e3     # distance between two (source_type, country) groups on the group axis, far above the tolerance
+
+
+def match_pairs(df_gt, df_llm, tolerance=TOLERANCE):
+    """
+    All the (ground truth, LLM) row pairs that match: same source_type and country, same year
+    (a ground truth year of 0 matches any year) and |dx| <= tolerance and |dy| <= tolerance.
+    The (source_type, country) group is encoded as a third coordinate spaced far apart,
+    so that a single KD-tree query in the max norm finds the pairs of every group at once.
+
+    @params:
+        - df_gt, df_llm: occurrences with source_type, country, year, x and y columns
+        - tolerance: coordinate tolerance in degrees
+
+    @returns:
+        - (gt positions, llm positions, distances) arrays, positions being row numbers in the DataFrames
+    """
+    keys = pd.concat([df_gt[["source_type", "country"]], df_llm[["source_type", "country"]]]).astype(str)
+    groups = pd.MultiIndex.from_frame(keys).factorize()[0].astype(float) * GROUP_SPACING
+
+    def points(df, group):
+        xyz = np.column_stack([df["x"].to_numpy(float), df["y"].to_numpy(float), group])
+        valid = np.flatnonzero(~np.isnan(xyz).any(axis=1))
+        return xyz[valid], valid
+
+    gt_xyz, gt_rows = points(df_gt, groups[:len(df_gt)])
+    llm_xyz, llm_rows = points(df_llm, groups[len(df_gt):])
+    empty = np.array([], dtype=int)
+    if len(gt_xyz) == 0 or len(llm_xyz) == 0:
+        return empty, empty, np.array([])
+
+    pairs = cKDTree(gt_xyz).sparse_distance_matrix(cKDTree(llm_xyz), tolerance, p=np.inf, output_type="ndarray")
+    gt_pos, llm_pos = gt_rows[pairs["i"]], llm_rows[pairs["j"]]
+
+    gt_year = df_gt["year"].to_numpy()[gt_pos]
+    llm_year = df_llm["year"].to_numpy()[llm_pos]
+    keep = (gt_year == llm_year) | (gt_year == 0)
+    return gt_pos[keep], llm_pos[keep], pairs["v"][keep]
+
+def greedy_assignment(gt_pos, llm_pos, distances):
+    """
+    One-to-one matching: pairs are taken by increasing distance when both rows are still free
+    """
+    used_gt, used_llm, kept = set(), set(), []
+    for k in np.argsort(distances, kind="stable"):
+        if gt_pos[k] not in used_gt and llm_pos[k] not in used_llm:
+            used_gt.add(gt_pos[k])
+            used_llm.add(llm_pos[k])
+            kept.append(k)
+    kept = np.array(kept, dtype=int)
+    return gt_pos[kept], llm_pos[kept]
+
+def hungarian_assignment(gt_pos, llm_pos, distances):
+    """
+    One-to-one matching with the most pairs, and among those the smallest total distance,
+    solved separately on each connected set of candidate pairs
+    """
+    if len(gt_pos) == 0:
+        return gt_pos, llm_pos
+    gts, gt_idx = np.unique(gt_pos, return_inverse=True)
+    llms, llm_idx = np.unique(llm_pos, return_inverse=True)
+    graph = coo_matrix((np.ones(len(gt_idx)), (gt_idx, len(gts) + llm_idx)), shape=(len(gts) + len(llms),) * 2)
+    _, labels = connected_components(graph, directed=False)
+
+    matched_gt, matched_llm = [], []
+    pairs = pd.DataFrame({"gt": gt_idx, "llm": llm_idx, "d": distances, "component": labels[gt_idx]})
+    for _, group in pairs.groupby("component"):
+        rows, row_idx = np.unique(group["gt"], return_inverse=True)
+        cols, col_idx = np.unique(group["llm"], return_inverse=True)
+        # a non candidate pair costs more than all the candidate pairs together, the number of pairs comes first
+        cost = np.full((len(rows), len(cols)), group["d"].sum() + 1.0)
+        cost[row_idx, col_idx] = group["d"].to_numpy()
+        candidate = np.zeros(cost.shape, dtype=bool)
+        candidate[row_idx, col_idx] = True
+        assigned_rows, assigned_cols = linear_sum_assignment(cost)
+        valid = candidate[assigned_rows, assigned_cols]
+        matched_gt.extend(gts[rows[assigned_rows[valid]]])
+        matched_llm.extend(llms[cols[assigned_cols[valid]]])
+    return np.array(matched_gt, dtype=int), np.array(matched_llm, dtype=int)
+
+def compare(df_gt, df_llm, tolerance=TOLERANCE, assignment=None):
+    """
+    Precision, recall and F1 of the LLM occurrences against the ground truth.
+    By default, as in the original notebook comparison, an LLM row is a true positive if it matches any ground truth row
+    and a ground truth row is a false negative if no LLM row matches it.
+
+    @params:
+        - df_gt: ground truth occurrences
+        - df_llm: LLM occurrences
+        - tolerance: coordinate tolerance in degrees
+        - assignment: None, "greedy" or "hungarian" to match each ground truth row with at most one LLM row
+
+    @returns:
+        - F1, Precision, Recall, list of the false positive indices of df_llm, list of the false negative indices of df_gt,
+          false positive rows, false negative rows
+    """
+    gt_pos, llm_pos, distances = match_pairs(df_gt, df_llm, tolerance)
+    if assignment == "greedy":
+        gt_pos, llm_pos = greedy_assignment(gt_pos, llm_pos, distances)
+    elif assignment == "hungarian":
+        gt_pos, llm_pos = hungarian_assignment(gt_pos, llm_pos, distances)
+    elif assignment is not None:
+        raise ValueError(f"Unknown assignment {assignment}, expected None, 'greedy' or 'hungarian'")
+
+    tp_mask = np.zeros(len(df_llm), dtype=bool)
+    tp_mask[llm_pos] = True
+    fn_mask = np.ones(len(df_gt), dtype=bool)
+    fn_mask[gt_pos] = False
+
+    TP = int(tp_mask.sum())
+    FP = len(df_llm) - TP
+    FN = int(fn_mask.sum())
+    fp_df = df_llm[~tp_mask]
+    fn_df = df_gt[fn_mask]
+
+    Precision = TP / (TP + FP) if TP + FP else 0.0
+    Recall = TP / (TP + FN) if TP + FN else 0.0
+    F1 = 2 * Precision * Recall / (Precision + Recall) if Precision + Recall else 0.0
+
+    print(f"TP: {TP}, FP: {FP}, FN: {FN}")
+    print(f"Precision: {Precision:.3f}, Recall: {Recall:.3f}, F1: {F1:.3f}")
+
+    return F1, Precision, Recall, list(fp_df.index), list(fn_df.index), fp_df, fn_df
@@ -0,0 +1,265 @@
+# general import
+import os
+import sqlite3
+import time
+import pandas as pd
+import pycountry
+from geopy.geocoders import Nominatim
+from geopy.extra.rate_limiter import RateLimiter
+from country_utilities import convert_names
+
+GEOCODE_DB = "geocode_cache.sqlite"
+CACHE_TTL_DAYS = 365        # found locations are kept for a year
+NEGATIVE_TTL_DAYS = 30      # locations the geocoder did not find are retried after a month
+GEONAMES_FILE = "cities15000.txt"   # GeoNames dump (cities500.txt, cities15000.txt, allCountries.txt, ...)
+GEONAMES_FEATURE_CLASSES = {"P", "A"}   # populated places and administrative areas
+ADMIN1_FILE = "admin1CodesASCII.txt"    # GeoNames names of the first-level administrative divisions
+ADMIN1_FEATURE_CODE = "ADM1"
+NOMINATIM_DOMAIN = "nominatim.openstreetmap.org"
+NOMINATIM_SCHEME = "https"
+USER_AGENT = "geoapi"
+MIN_DELAY_SECONDS = 1.0     # Nominatim usage policy: at most one request per second
+ERROR_WAIT_SECONDS = 5.0
+MAX_RETRIES = 2
+EMPTY_RESULT = {'address': None, 'latitude': None, 'longitude': None}
+
+
+def normalize_location(location):
+    """
+    Cache key of a location: lower case, single spaces, no empty comma separated parts
+    """
+    parts = (" ".join(part.split()) for part in str(location).lower().split(","))
+    return ", ".join(part for part in parts if part)
+
+
+# Persistent cache
+
+def open_geocode_cache(path=GEOCODE_DB):
+    conn = sqlite3.connect(path)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS geocodes (
+            key TEXT PRIMARY KEY,
+            address TEXT,
+            latitude REAL,
+            longitude REAL,
+            source TEXT NOT NULL,
+            created REAL NOT NULL
+        )""")
+    conn.commit()
+    return conn
+
+def cache_lookup(conn, key, ttl_days=CACHE_TTL_DAYS, negative_ttl_days=NEGATIVE_TTL_DAYS):
+    """
+    Cached result of a location, not found results are cached too
+
+    @params:
+        - conn: the geocode cache
+        - key: the normalized location
+        - ttl_days, negative_ttl_days: age after which a found / not found entry is ignored
+
+    @returns:
+        - a result dictionary (with None coordinates for a cached miss), or None if the location is not cached
+    """
+    row = conn.execute("SELECT address, latitude, longitude, created FROM geocodes WHERE key = ?", (key,)).fetchone()
+    if row is None:
+        return None
+    address, latitude, longitude, created = row
+    ttl = ttl_days if latitude is not None else negative_ttl_days
+    if time.time() - created > ttl * 86400:
+        return None
+    return {'address': address, 'latitude': latitude, 'longitude': longitude}
+
+def cache_store(conn, key, result, source):
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO geocodes VALUES (?, ?, ?, ?, ?, ?)",
+                     (key, result['address'], result['latitude'], result['longitude'], source, time.time()))
+
+
+# Offline resolver
+
+def load_geonames(path=GEONAMES_FILE, feature_classes=GEONAMES_FEATURE_CLASSES):
+    """
+    Load a GeoNames dump (tab separated, http://download.geonames.org/export/dump/) as a name index
+
+    @params:
+        - path: path of the dump
+        - feature_classes: kept GeoNames feature classes
+
+    @returns:
+        - a dictionary normalized name -> list of (population, latitude, longitude, country code, name,
+          admin1 code, feature code), empty if the file does not exist
+    """
+    gazetteer = {}
+    if not path or not os.path.exists(path):
+        return gazetteer
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 15 or fields[6] not in feature_classes:
+                continue
+            entry = (int(fields[14] or 0), float(fields[4]), float(fields[5]), fields[8], fields[1], fields[10], fields[7])
+            names = {fields[1], fields[2]} | {name for name in fields[3].split(",") if name}
+            for name in names:
+                gazetteer.setdefault(normalize_location(name), []).append(entry)
+    return gazetteer
+
+def load_admin1_codes(path=ADMIN1_FILE):
+    """
+    Load the GeoNames admin1 codes (tab separated "US.CA", "California", "California", geonameid)
+
+    @returns:
+        - a dictionary normalized region name -> set of (country code, admin1 code), empty if the file does not exist
+    """
+    admin1_codes = {}
+    if not path or not os.path.exists(path):
+        return admin1_codes
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 3 or "." not in fields[0]:
+                continue
+            country, admin1 = fields[0].split(".", 1)
+            # alphabetic codes are also written as abbreviations, e.g. "Cambridge, MA, USA"
+            names = {fields[1], fields[2], admin1} if admin1.isalpha() else {fields[1], fields[2]}
+            for name in names:
+                admin1_codes.setdefault(normalize_location(name), set()).add((country, admin1))
+    return admin1_codes
+
+def country_code(name):
+    """
+    ISO2 code of a country name, aliases such as "UK" or "USA" are resolved with country_utilities
+    """
+    try:
+        return pycountry.countries.lookup(name.strip()).alpha_2
+    except LookupError:
+        pass
+    resolved = convert_names([name.strip()])[name.strip()]
+    return resolved["iso2"] if resolved else None
+
+def region_codes(regions, gazetteer, admin1_codes):
+    """
+    (country code, admin1 code) pairs of region names, from the admin1 codes and the ADM1 entries of the gazetteer
+    """
+    codes = set()
+    for region in regions:
+        codes |= admin1_codes.get(region, set())
+        codes |= {(entry[3], entry[5]) for entry in gazetteer.get(region, []) if entry[6] == ADMIN1_FEATURE_CODE}
+    return codes
+
+def resolve_offline(location, gazetteer, admin1_codes=None):
+    """
+    Resolve a "[Locality], [Region/Province/State], [Country]" location with the gazetteer:
+    the most specific part found in the gazetteer, in the country of the location when it is known.
+    Among homonyms, the places in the region named after the part win, then the most populated one.
+
+    @params:
+        - location: the location string
+        - gazetteer: index returned by load_geonames
+        - admin1_codes: index returned by load_admin1_codes, the region names are then only matched
+          with the ADM1 entries of the gazetteer if None
+
+    @returns:
+        - a result dictionary, or None if no part of the location is in the gazetteer
+    """
+    parts = [part for part in normalize_location(location).split(", ") if part]
+    if not parts or not gazetteer:
+        return None
+    code = country_code(parts[-1]) if len(parts) > 1 else None
+    places = parts[:-1] if code else parts
+    for i, part in enumerate(places):
+        candidates = gazetteer.get(part, [])
+        if code:
+            candidates = [candidate for candidate in candidates if candidate[3] == code]
+        if not candidates:
+            continue
+        regions = region_codes(places[i + 1:], gazetteer, admin1_codes or {})
+        in_region = [candidate for candidate in candidates if (candidate[3], candidate[5]) in regions]
+        _, latitude, longitude, found_code, name, _, _ = max(in_region or candidates)
+        return {'address': f"{name}, {found_code}", 'latitude': latitude, 'longitude': longitude}
+    return None
+
+
+# Online geocoder
+
+def make_geocoder(domain=NOMINATIM_DOMAIN, scheme=NOMINATIM_SCHEME, user_agent=USER_AGENT,
+                  min_delay_seconds=MIN_DELAY_SECONDS, max_retries=MAX_RETRIES, error_wait_seconds=ERROR_WAIT_SECONDS):
+    """
+    Nominatim geocode function throttled by geopy's RateLimiter. The domain and scheme can point to a self-hosted
+    Nominatim or to a local stand-in for tests. Errors are raised after the retries so that they are not cached.
+    """
+    geolocator = Nominatim(user_agent=user_agent, domain=domain, scheme=scheme)
+    return RateLimiter(geolocator.geocode, min_delay_seconds=min_delay_seconds, max_retries=max_retries,
+                       error_wait_seconds=error_wait_seconds, swallow_exceptions=False)
+
+def geocode_locations(locations, cache_path=GEOCODE_DB, gazetteer=None, admin1_codes=None, geocode=None):
+    """
+    Coordinates of locations: from the persistent cache, then from the offline gazetteer,
+    and only for the remaining ones from the online geocoder, one request at a time
+
+    @params:
+        - locations: iterable of locations, duplicates are looked up once
+        - cache_path: path of the geocode cache
+        - gazetteer: index returned by load_geonames, loaded from GEONAMES_FILE if None
+        - admin1_codes: index returned by load_admin1_codes, loaded from ADMIN1_FILE if None
+        - geocode: geocode function, make_geocoder() if None
+
+    @returns:
+        - a dictionary location -> {'address', 'latitude', 'longitude'}
+    """
+    if gazetteer is None:
+        gazetteer = load_geonames()
+    if admin1_codes is None:
+        admin1_codes = load_admin1_codes()
+    conn = open_geocode_cache(cache_path)
+    location_coords = {}
+    misses = {}     # normalized location -> spellings of the location, each one is sent once
+    stats = {"cache": 0, "offline": 0, "online": 0, "not found": 0, "errors": 0}
+
+    for location in dict.fromkeys(locations):
+        if pd.isna(location) or not normalize_location(location):
+            location_coords[location] = dict(EMPTY_RESULT)
+            continue
+        key = normalize_location(location)
+        result = cache_lookup(conn, key)
+        if result is not None:
+            stats["cache"] += 1
+        else:
+            result = resolve_offline(location, gazetteer, admin1_codes)
+            if result is None:
+                misses.setdefault(key, []).append(location)
+                continue
+            cache_store(conn, key, result, "offline")
+            stats["offline"] += 1
+        location_coords[location] = result
+
+    print(f"{len(location_coords)} locations resolved from the cache or the gazetteer, {len(misses)} sent to the online geocoder")
+    if misses and geocode is None:
+        geocode = make_geocoder()
+    for i, (key, spellings) in enumerate(misses.items(), 1):
+        try:
+            found = geocode(spellings[0])
+        except Exception as e:
+            # not cached, the location is retried on the next run
+            print(f"[{i}/{len(misses)}] ! Error on '{spellings[0]}': {str(e)}")
+            stats["errors"] += 1
+            result = EMPTY_RESULT
+        else:
+            if found:
+                result = {'address': found.address, 'latitude': found.latitude, 'longitude': found.longitude}
+                stats["online"] += 1
+            else:
+                result = EMPTY_RESULT
+                stats["not found"] += 1
+            cache_store(conn, key, result, "nominatim")
+        for location in spellings:
+            location_coords[location] = dict(result)
+
+    conn.close()
+    print("Geocoding: " + ", ".join(f"{name}: {count}" for name, count in stats.items()))
+    return location_coords
+
+def get_coordinates(df, **kwargs):
+    """
+    Coordinates of the unique locations of the location column, see geocode_locations for the options
+    """
+    return geocode_locations(df["location"].unique(), **kwargs)
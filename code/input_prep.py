@@ -1,22 +1,28 @@
 from text_proccessor_utilities import filter_species,filter_date_loc,combine_chunks
-import json
+from dedup_utilities import dedupe_chunks,PROVENANCE_FILE
+from jsonl_utilities import iter_records,write_jsonl
 
-FILE = "input.json"
-def prepare_input(input=FILE):
+FILE = "input.jsonl"
+def prepare_input(input=FILE,output=None,provenance_file=PROVENANCE_FILE):
     """
     wrap up the process to prepare the input
 
     @params:
-        - FILE: the input file
+        - input: the input file (JSON Lines, optionally .gz/.zst compressed, or legacy .json)
+        - output: the output file, the input file is overwritten if None
+        - provenance_file: where the chunks dropped as duplicates are recorded, see dedup_utilities.credit_duplicates
 
     """
 
+    data = iter_records(input)
     data = filter_species(data)
     data = filter_date_loc(data)
+    provenance = []
+    data = dedupe_chunks(data, provenance=provenance)
     data = combine_chunks(data)
 
-    with open(FILE,"w") as f:
-        json.dump(data,f,indent=4)
+    write_jsonl(data, output or input)
+    write_jsonl(provenance, provenance_file)
 
 
 if __name__=="__main__":
@@ -1,10 +1,13 @@
 from text_extractor_utilities import process_pdfs
 from text_proccessor_utilities import process_text_files,filter_species,filter_date_loc,combine_chunks
-import json
+from dedup_utilities import dedupe_chunks,PROVENANCE_FILE
+from jsonl_utilities import write_jsonl
+import os
 PDF_FOLDER = "pdf_folder"
 TEXT_FOLDER  = "text_folder"
-OUTPUT_FILE = "input.json"
-def prepare_input(pdf_folder=PDF_FOLDER,text_folder=TEXT_FOLDER,input=OUTPUT_FILE):
+OUTPUT_FILE = "input.jsonl"
+WORKERS = os.cpu_count() or 1
+def prepare_input(pdf_folder=PDF_FOLDER,text_folder=TEXT_FOLDER,input=OUTPUT_FILE,workers=WORKERS,provenance_file=PROVENANCE_FILE):
     """
     wrap up the process to prepare the input from folder of pdfs to input
 
@@ -12,16 +15,20 @@ def prepare_input(pdf_folder=PDF_FOLDER,text_folder=TEXT_FOLDER,input=OUTPUT_FIL
         - pdf_folder: folder that contains the pdfs
         - text_folder: folder that contains the texts
         - input : the input file 
+        - workers: number of cores used to extract the PDFs, shared by the PDF processes and their OCR
+        - provenance_file: where the chunks dropped as duplicates are recorded, see dedup_utilities.credit_duplicates
     """
 
-    process_pdfs(pdf_folder, text_folder)
+    process_pdfs(pdf_folder, text_folder, workers=workers)
     data = process_text_files(text_folder)
     data = filter_species(data)
     data = filter_date_loc(data)
+    provenance = []
+    data = dedupe_chunks(data, provenance=provenance)
     data = combine_chunks(data)
 
-    with open(input,"w") as f:
-        json.dump(data,f,indent=4)
+    write_jsonl(data, input)
+    write_jsonl(provenance, provenance_file)
 
 
 if __name__=="__main__":
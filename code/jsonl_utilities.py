@@ -0,0 +1,90 @@
+# general import
+import gzip
+import io
+import json
+import os
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def open_jsonl(path, mode="r"):
+    """
+    Open a JSON Lines file in text mode, compressed according to its extension
+    (.gz for gzip, .zst for zstandard, plain text otherwise)
+
+    @params:
+        - path: path of the file
+        - mode: "r", "w" or "a"
+
+    @returns:
+        - a text file object
+    """
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    if path.endswith(".zst"):
+        if zstandard is None:
+            raise ImportError("zstandard is required to read or write .zst files")
+        if mode == "r":
+            stream = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True)
+        else:
+            stream = zstandard.ZstdCompressor().stream_writer(open(path, mode + "b"), closefd=True)
+        return io.TextIOWrapper(stream, encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+def read_jsonl(path):
+    """
+    Read a JSON Lines file record by record
+
+    @params:
+        - path: path of the file
+
+    @returns:
+        - a generator of records
+    """
+    with open_jsonl(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+def iter_records(path):
+    """
+    Read records from a JSON Lines file, or from a legacy JSON array file (.json)
+
+    @params:
+        - path: path of the file
+
+    @returns:
+        - a generator of records
+    """
+    if path.endswith(".json"):
+        with open(path, "r", encoding="utf-8") as f:
+            yield from json.load(f)
+    else:
+        yield from read_jsonl(path)
+
+def write_jsonl(records, path):
+    """
+    Write records to a JSON Lines file one at a time.
+    The records are written to a temporary file which replaces the target at the end,
+    so the target can also be the file the records are streamed from.
+
+    @params:
+        - records: an iterable of records
+        - path: path of the file
+
+    @returns:
+        - the number of records written
+    """
+    directory, filename = os.path.split(path)
+    tmp_path = os.path.join(directory, f".{filename}.tmp{os.path.splitext(path)[1]}")
+    count = 0
+    with open_jsonl(tmp_path, "w") as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            count += 1
+    os.replace(tmp_path, path)
+    return count
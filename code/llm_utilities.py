@@ -0,0 +1,467 @@
+# general import
+import json
+import os
+import re
+import copy
+import threading
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+import torch
+from tqdm import tqdm
+from transformers import LogitsProcessorList
+from constrained_decoding import OccurrenceJSONProcessor, parse_occurrences
+from result_store import prompt_hash, chunk_key, is_completed, save_results, iter_results
+
+with open("prompts.json","r") as f:
+    PROMPTS = json.load(f)
+
+COLUMNS = ["vector","location","country","date","year","source_type"]
+GENERATION_KWARGS = {"max_new_tokens": 512, "do_sample": True, "temperature": 1e-12, "top_k": 50}
+BATCH_SIZE = 8          # maximum number of prompts per generate call
+TOKEN_BUDGET = 16384    # maximum padded prompt + generated tokens per generate call
+GROUP_SIZE = 256        # chunks read from the stream and sorted by length at once
+
+# fast tokenizers cannot be used from two threads at once, generation itself runs unlocked
+TOKENIZER_LOCK = threading.Lock()
+
+# field filled in each prompt template, everything before it is a static prefix
+PROMPT_FIELDS = {"summary_prompt": "text", "structuration_prompt": "summary", "extraction_prompt": "text"}
+PREFIX_CACHES = {}
+
+
+def extract_json(text):
+    # Regex pattern to match JSON objects
+    json_pattern = r'\{[^{}]*\}'
+    matches = re.findall(json_pattern, text)
+
+    valid_jsons = []
+    for match in matches:
+        try:
+            # Attempt to parse the JSON
+            match = re.sub(r'(":\s*)([A-Za-z][^",\n}]*)', r'\1"\2"', match)
+            json_obj = json.loads(match)
+            valid_jsons.append(json_obj)
+        except json.JSONDecodeError:
+            continue
+
+    return valid_jsons
+
+
+def extract_summary(text_arg):
+    return text_arg.split("YOUR SUMMARY:", 1)[-1].strip()
+
+
+def extract_output(text_arg):
+    return text_arg.split("YOUR OUTPUT:", 1)[-1].strip()
+
+def summarize(chunk,device,tokenizer,model):
+    prompt_template = PROMPTS["summary_prompt"]
+    prompt = prompt_template.format(text=chunk["text"])
+    inputs = tokenizer(prompt, return_tensors="pt").to(device)
+    outputs = model.generate(**inputs,**GENERATION_KWARGS)
+    output = tokenizer.decode(outputs[0], skip_special_tokens=True)
+    output = extract_summary(output)
+    return output
+
+def structure(summary,device,tokenizer,model):
+    prompt_template = PROMPTS["structuration_prompt"]
+    prompt = prompt_template.format(summary=summary)
+    inputs = tokenizer(prompt, return_tensors="pt").to(device)
+    outputs = model.generate(**inputs,**GENERATION_KWARGS)
+    output = tokenizer.decode(outputs[0], skip_special_tokens=True)
+    output = extract_output(output)
+    output = extract_json(output)
+    return output
+
+def to_rows(output, source_type):
+    """
+    Keep the expected columns of the extracted occurrences and attach their source_type
+    """
+    rows = []
+    for item in output:
+        item["source_type"] = source_type
+        rows.append(dict((k, item[k]) for k in COLUMNS if k in item))
+    return rows
+
+def occurrence_key(row):
+    """
+    Identity of an occurrence: the same vector, location and time in the same document
+    """
+    return tuple(" ".join(str(row.get(k, "")).lower().split()) for k in ("source_type", "vector", "location", "date", "year"))
+
+def dedupe_rows(rows, seen):
+    """
+    Drop the occurrences already extracted, e.g. from the overlap of two windows of a document
+
+    @params:
+        - rows: list of occurrence rows
+        - seen: set of the occurrence keys already written, updated in place
+    """
+    kept = []
+    for row in rows:
+        key = occurrence_key(row)
+        if key not in seen:
+            seen.add(key)
+            kept.append(row)
+    return kept
+
+def is_out_of_memory(error):
+    return 'out of memory' in str(error).lower()
+
+# Batched inference
+
+def prepare_tokenizer(tokenizer):
+    """
+    Decoder-only models must be padded on the left for batched generation.
+    Llama tokenizers have no padding token, the end of sequence token is used instead.
+    """
+    tokenizer.padding_side = "left"
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    return tokenizer
+
+def make_batches(lengths, batch_size=BATCH_SIZE, token_budget=TOKEN_BUDGET, max_new_tokens=GENERATION_KWARGS["max_new_tokens"]):
+    """
+    Group prompts of similar token length so that little padding is needed
+
+    @params:
+        - lengths: token length of each prompt
+        - batch_size: maximum number of prompts per batch
+        - token_budget: maximum of batch size x (longest prompt + max_new_tokens)
+        - max_new_tokens: number of tokens generated per prompt
+
+    @returns:
+        - list of batches, each a list of prompt indices
+    """
+    batches = []
+    current = []
+    for idx in sorted(range(len(lengths)), key=lengths.__getitem__):
+        # indices are sorted by length, the new prompt is the longest of the batch
+        padded_tokens = (len(current) + 1) * (lengths[idx] + max_new_tokens)
+        if current and (len(current) == batch_size or padded_tokens > token_budget):
+            batches.append(current)
+            current = []
+        current.append(idx)
+    if current:
+        batches.append(current)
+    return batches
+
+def constrained_kwargs(tokenizer, constrained):
+    """
+    Extra generate arguments restricting the output to the occurrence JSON schema
+    """
+    if not constrained:
+        return {}
+    return {"logits_processor": LogitsProcessorList([OccurrenceJSONProcessor(tokenizer)])}
+
+def decode_outputs(outputs, prompt_length, tokenizer, generated_only):
+    """
+    Decode generate outputs, only the tokens after the prompt_length prompt tokens if generated_only
+    """
+    if generated_only:
+        outputs = outputs[:, prompt_length:]
+    with TOKENIZER_LOCK:
+        return tokenizer.batch_decode(outputs, skip_special_tokens=True)
+
+def generate_batch(prompts, device, tokenizer, model, constrained=False, generated_only=False):
+    """
+    Run generate on a left-padded batch of prompts
+
+    @returns:
+        - the decoded prompt + generation of each prompt, the generation alone if generated_only
+    """
+    with TOKENIZER_LOCK:
+        inputs = tokenizer(prompts, return_tensors="pt", padding=True).to(device)
+    with torch.no_grad():
+        outputs = model.generate(**inputs, pad_token_id=tokenizer.pad_token_id, **GENERATION_KWARGS, **constrained_kwargs(tokenizer, constrained))
+    return decode_outputs(outputs, inputs["input_ids"].shape[1], tokenizer, generated_only)
+
+# Shared-prefix KV cache
+
+def split_prompt(prompt_name):
+    """
+    Split a prompt template into its static prefix and the part that varies with each input.
+    The prefix ends on a line break so that its tokens are usually the same whether it is tokenized
+    alone or as part of the whole prompt, generate_batch_with_prefix checks it for each batch.
+
+    @returns:
+        - a (prefix, head, tail) tuple, a prompt is prefix + head + input + tail
+    """
+    sentinel = "\x00"
+    formatted = PROMPTS[prompt_name].format(**{PROMPT_FIELDS[prompt_name]: sentinel})
+    before, tail = formatted.split(sentinel)
+    cut = before.rfind("\n") + 1
+    return before[:cut], before[cut:], tail
+
+def build_prefix_cache(prompt_name, device, tokenizer, model):
+    """
+    Encode the static prefix of a prompt template once and keep its past key/values
+
+    @returns:
+        - a dictionary with the prefix token ids, its KV cache and the variable parts of the template
+    """
+    prefix, head, tail = split_prompt(prompt_name)
+    with TOKENIZER_LOCK:
+        prefix_ids = tokenizer(prefix, return_tensors="pt")["input_ids"].to(device)
+    with torch.no_grad():
+        past_key_values = model(input_ids=prefix_ids, use_cache=True).past_key_values
+    return {"prefix": prefix, "prefix_ids": prefix_ids, "past_key_values": past_key_values, "head": head, "tail": tail}
+
+def get_prefix_cache(prompt_name, device, tokenizer, model):
+    """
+    Prefix caches are computed once per loaded model and prompt template
+    """
+    key = (prompt_name, id(model))
+    if key not in PREFIX_CACHES:
+        PREFIX_CACHES[key] = build_prefix_cache(prompt_name, device, tokenizer, model)
+    return PREFIX_CACHES[key]
+
+def generate_batch_with_prefix(inputs, prefix_cache, device, tokenizer, model, constrained=False, generated_only=False):
+    """
+    Run generate on a batch of prompts sharing a cached prefix.
+    Each row is laid out as [prefix][padding][variable part]: the padding sits between the prefix and the
+    variable part so that every row reuses the same prefix key/values, and is masked out by the attention
+    mask (position ids are derived from the mask, so the variable part follows the prefix positions).
+
+    @params:
+        - inputs: the texts filled in the template
+        - prefix_cache: the cache returned by get_prefix_cache
+
+    @returns:
+        - the decoded prompt + generation of each input, the generation alone if generated_only
+    """
+    batch_size = len(inputs)
+    texts = [prefix_cache["head"] + text + prefix_cache["tail"] for text in inputs]
+    with TOKENIZER_LOCK:
+        variable = tokenizer(texts, return_tensors="pt", padding=True, add_special_tokens=False).to(device)
+        full_ids = tokenizer([prefix_cache["prefix"] + text for text in texts])["input_ids"]
+    # the cached prefix is only valid if the whole prompt tokenizes as prefix tokens + variable tokens,
+    # i.e. no token is merged across the split point, otherwise the batch is run without the cache
+    prefix_list = prefix_cache["prefix_ids"][0].tolist()
+    for ids, mask, full in zip(variable["input_ids"].tolist(), variable["attention_mask"].tolist(), full_ids):
+        if full != prefix_list + [token for token, kept in zip(ids, mask) if kept]:
+            print("Prompt tokens differ from the cached prefix tokens, batch run without the prefix cache")
+            return generate_batch([prefix_cache["prefix"] + text for text in texts], device, tokenizer, model, constrained, generated_only)
+    prefix_ids = prefix_cache["prefix_ids"].expand(batch_size, -1)
+    input_ids = torch.cat([prefix_ids, variable["input_ids"]], dim=1)
+    attention_mask = torch.cat([torch.ones_like(prefix_ids), variable["attention_mask"]], dim=1)
+
+    # generate appends to the cache, work on a copy expanded to the batch
+    past_key_values = copy.deepcopy(prefix_cache["past_key_values"])
+    past_key_values.batch_repeat_interleave(batch_size)
+    with torch.no_grad():
+        outputs = model.generate(input_ids=input_ids, attention_mask=attention_mask, past_key_values=past_key_values,
+                                 pad_token_id=tokenizer.pad_token_id, **GENERATION_KWARGS, **constrained_kwargs(tokenizer, constrained))
+    return decode_outputs(outputs, input_ids.shape[1], tokenizer, generated_only)
+
+def generate_batch_safe(prompts, device, tokenizer, model, prefix_cache=None, constrained=False, generated_only=False):
+    """
+    generate_batch that splits the batch in two on out of memory errors,
+    a prompt that does not fit alone gives None.
+    With a prefix_cache, prompts are the texts filled in the template.
+    """
+    try:
+        if prefix_cache is not None:
+            return generate_batch_with_prefix(prompts, prefix_cache, device, tokenizer, model, constrained, generated_only)
+        return generate_batch(prompts, device, tokenizer, model, constrained, generated_only)
+    except RuntimeError as e:
+        if not is_out_of_memory(e):
+            raise
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        if len(prompts) == 1:
+            print("Out of memory error on a prompt, skipping...")
+            return [None]
+        half = len(prompts) // 2
+        return (generate_batch_safe(prompts[:half], device, tokenizer, model, prefix_cache, constrained, generated_only)
+                + generate_batch_safe(prompts[half:], device, tokenizer, model, prefix_cache, constrained, generated_only))
+
+def summarize_batch(chunks, device, tokenizer, model, use_prefix_cache=False):
+    if use_prefix_cache:
+        prefix_cache = get_prefix_cache("summary_prompt", device, tokenizer, model)
+        outputs = generate_batch_safe([chunk["text"] for chunk in chunks], device, tokenizer, model, prefix_cache)
+    else:
+        prompts = [PROMPTS["summary_prompt"].format(text=chunk["text"]) for chunk in chunks]
+        outputs = generate_batch_safe(prompts, device, tokenizer, model)
+    return [extract_summary(output) if output is not None else None for output in outputs]
+
+def structure_batch(summaries, device, tokenizer, model, use_prefix_cache=False):
+    if use_prefix_cache:
+        prefix_cache = get_prefix_cache("structuration_prompt", device, tokenizer, model)
+        outputs = generate_batch_safe(summaries, device, tokenizer, model, prefix_cache)
+    else:
+        prompts = [PROMPTS["structuration_prompt"].format(summary=summary) for summary in summaries]
+        outputs = generate_batch_safe(prompts, device, tokenizer, model)
+    return [extract_json(extract_output(output)) if output is not None else None for output in outputs]
+
+def extract_batch(chunks, device, tokenizer, model, use_prefix_cache=False):
+    """
+    Single-pass extraction: the occurrences are decoded directly as JSON constrained to the occurrence schema,
+    only the generated tokens are decoded since the prompt itself contains an example output
+    """
+    if use_prefix_cache:
+        prefix_cache = get_prefix_cache("extraction_prompt", device, tokenizer, model)
+        outputs = generate_batch_safe([chunk["text"] for chunk in chunks], device, tokenizer, model, prefix_cache, constrained=True, generated_only=True)
+    else:
+        prompts = [PROMPTS["extraction_prompt"].format(text=chunk["text"]) for chunk in chunks]
+        outputs = generate_batch_safe(prompts, device, tokenizer, model, constrained=True, generated_only=True)
+    return [parse_occurrences(output) if output is not None else None for output in outputs]
+
+def iter_batches(full_texts, tokenizer, batch_size=BATCH_SIZE, token_budget=TOKEN_BUDGET, group_size=GROUP_SIZE, prompt_name="summary_prompt"):
+    """
+    Read the chunk stream group by group and split each group into length-sorted batches
+    """
+    full_texts = iter(full_texts)
+    template_length = len(tokenizer(PROMPTS[prompt_name].format(**{PROMPT_FIELDS[prompt_name]: ""}))["input_ids"])
+    while True:
+        group = list(islice(full_texts, group_size))
+        if not group:
+            return
+        with TOKENIZER_LOCK:
+            lengths = [template_length + len(ids) for ids in tokenizer([chunk["text"] for chunk in group], add_special_tokens=False)["input_ids"]]
+        for batch in make_batches(lengths, batch_size, token_budget):
+            yield [group[idx] for idx in batch]
+
+# Result store
+
+def run_signature(prompt_names, model):
+    """
+    (prompt hash, model name) identifying an extraction run in the result store, model is the loaded model or its name
+    """
+    model_name = model if isinstance(model, str) else getattr(model, "name_or_path", None) or type(model).__name__
+    return prompt_hash([PROMPTS[name] for name in prompt_names], GENERATION_KWARGS), model_name
+
+def skip_completed(full_texts, store, signature, keys=None):
+    """
+    Drop the chunks already processed with the same prompts and model.
+    The key of every input chunk, skipped or not, is appended to keys (a list) when given.
+    """
+    skipped = 0
+    for chunk in full_texts:
+        if keys is not None:
+            keys.append(chunk_key(chunk))
+        if is_completed(store, chunk, *signature):
+            skipped += 1
+        else:
+            yield chunk
+    if skipped:
+        print(f"{skipped} chunks already in the result store were skipped")
+
+def write_results(results, output_file, seen, store=None, signature=None):
+    """
+    Write the occurrences of a batch: appended to the CSV, or recorded in the result store
+
+    @params:
+        - results: list of (chunk, occurrences) of the chunks processed successfully
+        - output_file: the CSV the occurrences are appended to when there is no store
+        - seen: set of the occurrence keys already written
+        - store, signature: the result store and the run signature
+    """
+    if store is not None:
+        save_results(store, results, *signature)
+        return
+    rows = dedupe_rows([row for _, occurrences in results for row in occurrences], seen)
+    if rows:
+        pd.DataFrame(rows, columns=COLUMNS).to_csv(output_file, mode="a", index=False, header=not os.path.exists(output_file))
+
+def export_results(store, signature, output_file, keys=None):
+    """
+    Rewrite the output CSV from the result store, with the occurrences of the current prompts and model only,
+    and of the chunks of keys (see skip_completed) when given
+    """
+    rows = dedupe_rows(list(iter_results(store, *signature, keys=keys)), set())
+    pd.DataFrame(rows, columns=COLUMNS).to_csv(output_file, index=False)
+    print(f"{len(rows)} occurrences written to {output_file}")
+
+def extract_data_batched(full_texts, output_file, device, tokenizer, model, batch_size=BATCH_SIZE, token_budget=TOKEN_BUDGET, pipeline=True, use_prefix_cache=True, store=None, on_batch=None):
+    """
+    Batched version of extract_data: chunks of similar length are summarized and structured together.
+    With pipeline, the summaries of the next batch are generated while the current batch is structured.
+    An occurrence found in several windows of a document (see pack_chunks) is written once.
+
+    @params:
+        - full_texts: iterable of chunks with source_type and text
+        - output_file: the CSV the occurrences are appended to
+        - device, tokenizer, model: the loaded model
+        - batch_size: maximum number of chunks per generate call
+        - token_budget: maximum padded prompt + generated tokens per generate call
+        - pipeline: overlap the summary and structure stages of consecutive batches
+        - use_prefix_cache: reuse the key/values of the static prefix of the prompts instead of re-encoding it
+        - store: optional result store (result_store.open_store). Chunks already processed with the same prompts
+          and model are skipped, results are committed after each batch and output_file is rewritten from the store
+          at the end (unless it is None) with the occurrences of the input chunks, so an interrupted run can be restarted.
+        - on_batch: optional function called after the results of each batch are written, e.g. to renew a task lease
+    """
+    prepare_tokenizer(tokenizer)
+    signature = run_signature(("summary_prompt", "structuration_prompt"), model)
+    keys = []
+    if store is not None:
+        full_texts = skip_completed(full_texts, store, signature, keys)
+    if use_prefix_cache:
+        # built before the worker thread starts so that it is computed once
+        for prompt_name in ("summary_prompt", "structuration_prompt"):
+            get_prefix_cache(prompt_name, device, tokenizer, model)
+    batches = iter_batches(full_texts, tokenizer, batch_size, token_budget)
+    seen = set()
+
+    with ThreadPoolExecutor(max_workers=1) as executor, tqdm() as progress:
+        def submit(batch):
+            if batch is None:
+                return None
+            if pipeline:
+                return executor.submit(summarize_batch, batch, device, tokenizer, model, use_prefix_cache)
+            return summarize_batch(batch, device, tokenizer, model, use_prefix_cache)
+
+        batch = next(batches, None)
+        pending = submit(batch)
+        while batch is not None:
+            summaries = pending.result() if pipeline else pending
+            next_batch = next(batches, None)
+            pending = submit(next_batch)
+
+            kept = [(chunk, summary) for chunk, summary in zip(batch, summaries) if summary is not None]
+            outputs = structure_batch([summary for _, summary in kept], device, tokenizer, model, use_prefix_cache) if kept else []
+            # chunks that ran out of memory (None) are left out, so they are retried on restart
+            results = [(chunk, to_rows(output, chunk["source_type"])) for (chunk, _), output in zip(kept, outputs) if output is not None]
+            write_results(results, output_file, seen, store, signature)
+            if on_batch is not None:
+                on_batch()
+            progress.update(len(batch))
+            batch = next_batch
+
+    if store is not None and output_file is not None:
+        export_results(store, signature, output_file, keys)
+
+def extract_data_single_pass(full_texts, output_file, device, tokenizer, model, batch_size=BATCH_SIZE, token_budget=TOKEN_BUDGET, use_prefix_cache=True, store=None, on_batch=None):
+    """
+    Single-pass alternative to extract_data_batched: one constrained generation per chunk with the extraction prompt
+    instead of a summary followed by a structuration. The output is always a parseable occurrence array.
+    An occurrence found in several windows of a document (see pack_chunks) is written once.
+
+    @params:
+        - full_texts: iterable of chunks with source_type and text
+        - output_file: the CSV the occurrences are appended to, keep it separate from the two-pass output to compare them
+        - device, tokenizer, model: the loaded model
+        - batch_size: maximum number of chunks per generate call
+        - token_budget: maximum padded prompt + generated tokens per generate call
+        - use_prefix_cache: reuse the key/values of the static prefix of the prompt instead of re-encoding it
+        - store, on_batch: see extract_data_batched
+    """
+    prepare_tokenizer(tokenizer)
+    signature = run_signature(("extraction_prompt",), model)
+    keys = []
+    if store is not None:
+        full_texts = skip_completed(full_texts, store, signature, keys)
+    seen = set()
+    with tqdm() as progress:
+        for batch in iter_batches(full_texts, tokenizer, batch_size, token_budget, prompt_name="extraction_prompt"):
+            outputs = extract_batch(batch, device, tokenizer, model, use_prefix_cache)
+            results = [(chunk, to_rows(output, chunk["source_type"])) for chunk, output in zip(batch, outputs) if output is not None]
+            write_results(results, output_file, seen, store, signature)
+            if on_batch is not None:
+                on_batch()
+            progress.update(len(batch))
+
+    if store is not None and output_file is not None:
+        export_results(store, signature, output_file, keys)
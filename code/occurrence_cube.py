@@ -0,0 +1,244 @@
+# general import
+import os
+import sys
+import numpy as np
+import pandas as pd
+from country_utilities import continent_column
+
+CUBE_FILE = "occurrence_cube_{}.npz"    # one cube per dataset variant (gt, pred, updated)
+GRID = "latlon"         # "latlon" (regular grid in degrees) or "h3" (requires the h3 package)
+RESOLUTION = 1.0        # cell size in degrees for "latlon", H3 resolution (0-15) for "h3"
+CELL_COLUMNS = ["species_idx", "year", "cell", "country_idx"]
+
+
+# Grid
+
+def latlon_cells(x, y, resolution=RESOLUTION):
+    """
+    Cell number of each point on a regular grid: row from the south pole, column from the antimeridian
+    """
+    n_cols = int(round(360 / resolution))
+    n_rows = int(round(180 / resolution))
+    col = np.clip(np.floor((np.asarray(x, float) + 180) / resolution), 0, n_cols - 1).astype(np.int64)
+    row = np.clip(np.floor((np.asarray(y, float) + 90) / resolution), 0, n_rows - 1).astype(np.int64)
+    return row * n_cols + col
+
+def latlon_centers(cells, resolution=RESOLUTION):
+    n_cols = int(round(360 / resolution))
+    row, col = np.divmod(np.asarray(cells, np.int64), n_cols)
+    return (col + 0.5) * resolution - 180, (row + 0.5) * resolution - 90
+
+def grid_cells(x, y, grid=GRID, resolution=RESOLUTION):
+    if grid == "latlon":
+        return latlon_cells(x, y, resolution)
+    if grid == "h3":
+        import h3
+        return np.array([int(h3.latlng_to_cell(lat, lng, int(resolution)), 16) for lng, lat in zip(x, y)], dtype=np.int64)
+    raise ValueError(f"Unknown grid {grid}, expected 'latlon' or 'h3'")
+
+def cell_centers(cells, grid=GRID, resolution=RESOLUTION):
+    """
+    (x, y) arrays of the longitude and latitude of the cell centers
+    """
+    if grid == "latlon":
+        return latlon_centers(cells, resolution)
+    import h3
+    centers = np.array([h3.cell_to_latlng(format(int(cell), "x")) for cell in cells], dtype=float).reshape(-1, 2)
+    return centers[:, 1], centers[:, 0]
+
+
+# Building and updating
+
+def empty_cube(grid=GRID, resolution=RESOLUTION):
+    """
+    Cube without occurrences. A cube is a dictionary of NumPy arrays: the vocabularies species, countries and
+    regions (continent of each country), the sparse counts as one entry per non-empty
+    (species_idx, year, cell, country_idx) coordinate with its count, and the hashes of the counted rows
+    """
+    return {
+        "grid": np.array(grid),
+        "resolution": np.array(float(resolution)),
+        "species": np.array([], dtype=str),
+        "countries": np.array([], dtype=str),
+        "regions": np.array([], dtype=str),
+        "species_idx": np.array([], dtype=np.int32),
+        "year": np.array([], dtype=np.int32),
+        "cell": np.array([], dtype=np.int64),
+        "country_idx": np.array([], dtype=np.int32),
+        "count": np.array([], dtype=np.int64),
+        "row_hashes": np.array([], dtype=np.uint64),
+    }
+
+def extend_vocabulary(vocabulary, values):
+    """
+    Append the new values at the end of a vocabulary, so that the indices already stored stay valid
+
+    @returns:
+        - the new vocabulary and the index of each value in it
+    """
+    new = pd.Index(pd.unique(values)).difference(vocabulary)
+    vocabulary = np.concatenate([vocabulary.astype(object), np.asarray(new, dtype=object)]).astype(str)
+    return vocabulary, pd.Index(vocabulary).get_indexer(values)
+
+def update_cube(cube, dataset):
+    """
+    Add the occurrences of a dataset to the cube. Rows already counted (same vector, source_type, country,
+    year and coordinates) are skipped, so results can be added again when new extractions arrive.
+
+    @params:
+        - cube: the cube, e.g. from load_cube or empty_cube
+        - dataset: occurrences with the visualization.normalize_dataset columns (vector, source_type, country, year, x, y)
+
+    @returns:
+        - the updated cube, the number of rows added
+    """
+    columns = ["vector", "source_type", "country", "year", "x", "y"]
+    rows = dataset[columns].dropna(subset=["x", "y"]).astype({"source_type": int, "year": int, "x": float, "y": float})
+    # a missing name is kept as an empty string, astype(str) leaves NaN as is
+    rows[["vector", "country"]] = rows[["vector", "country"]].fillna("").astype(str)
+    hashes = pd.util.hash_pandas_object(rows, index=False).to_numpy(np.uint64)
+    new = ~np.isin(hashes, cube["row_hashes"])
+    # duplicated rows are counted once, as normalize_dataset does
+    new &= ~pd.Series(hashes).duplicated().to_numpy()
+    rows, hashes = rows[new], hashes[new]
+    if len(rows) == 0:
+        return cube, 0
+
+    cube = dict(cube)
+    grid, resolution = str(cube["grid"]), float(cube["resolution"])
+    cube["species"], species_idx = extend_vocabulary(cube["species"], rows["vector"].to_numpy())
+    old_countries = len(cube["countries"])
+    cube["countries"], country_idx = extend_vocabulary(cube["countries"], rows["country"].to_numpy())
+    new_regions = continent_column(pd.Series(cube["countries"][old_countries:], dtype=str)).to_numpy(str)
+    cube["regions"] = np.concatenate([cube["regions"], new_regions]).astype(str)
+
+    added = pd.DataFrame({
+        "species_idx": species_idx,
+        "year": rows["year"].to_numpy(),
+        "cell": grid_cells(rows["x"].to_numpy(), rows["y"].to_numpy(), grid, resolution),
+        "country_idx": country_idx,
+        "count": 1,
+    })
+    current = pd.DataFrame({column: cube[column] for column in CELL_COLUMNS + ["count"]})
+    merged = pd.concat([current, added]).groupby(CELL_COLUMNS, as_index=False, sort=True)["count"].sum()
+    for column, dtype in zip(CELL_COLUMNS + ["count"], [np.int32, np.int32, np.int64, np.int32, np.int64]):
+        cube[column] = merged[column].to_numpy(dtype)
+    cube["row_hashes"] = np.sort(np.concatenate([cube["row_hashes"], hashes]))
+    return cube, len(rows)
+
+def build_cube(datasets, grid=GRID, resolution=RESOLUTION):
+    """
+    Cube of one or several datasets (e.g. the output of both species)
+    """
+    cube = empty_cube(grid, resolution)
+    for dataset in datasets:
+        cube, _ = update_cube(cube, dataset)
+    return cube
+
+def save_cube(cube, path):
+    tmp_path = path + ".tmp.npz"
+    np.savez_compressed(tmp_path, **cube)
+    os.replace(tmp_path, path)
+
+def load_cube(path):
+    with np.load(path, allow_pickle=False) as data:
+        return {key: data[key] for key in data.files}
+
+
+# Queries
+
+def select(cube, species=None, years=None, region=None, country=None, bbox=None):
+    """
+    Mask of the cube entries in a range
+
+    @params:
+        - cube: the cube
+        - species: species name or list of names (vector column, e.g. "Aedes aegypti"), all if None
+        - years: (first, last) inclusive year span, all if None
+        - region: continent name or list of names (region column)
+        - country: country name or list of names
+        - bbox: (min x, max x, min y, max y) box in degrees, containing the cell centers
+
+    @returns:
+        - a boolean array over the entries
+    """
+    mask = np.ones(len(cube["count"]), dtype=bool)
+    if species is not None:
+        mask &= np.isin(cube["species"], np.atleast_1d(species))[cube["species_idx"]]
+    if years is not None:
+        mask &= (cube["year"] >= years[0]) & (cube["year"] <= years[1])
+    if region is not None:
+        mask &= np.isin(cube["regions"], np.atleast_1d(region))[cube["country_idx"]]
+    if country is not None:
+        mask &= np.isin(cube["countries"], np.atleast_1d(country))[cube["country_idx"]]
+    if bbox is not None:
+        x, y = cell_centers(cube["cell"], str(cube["grid"]), float(cube["resolution"]))
+        mask &= (x >= bbox[0]) & (x <= bbox[1]) & (y >= bbox[2]) & (y <= bbox[3])
+    return mask
+
+def range_sum(cube, **ranges):
+    """
+    Number of occurrences in a range, see select for the ranges, e.g. range_sum(cube, region="Asia", years=(2000, 2010))
+    """
+    return int(cube["count"][select(cube, **ranges)].sum())
+
+def to_frame(cube, **ranges):
+    """
+    Entries of the cube as a DataFrame in the normalize_dataset schema (vector, country, year, x, y, region),
+    x and y being the cell center, with an occurrences column
+    """
+    mask = select(cube, **ranges)
+    x, y = cell_centers(cube["cell"][mask], str(cube["grid"]), float(cube["resolution"]))
+    country_idx = cube["country_idx"][mask]
+    return pd.DataFrame({
+        "vector": cube["species"][cube["species_idx"][mask]],
+        "country": cube["countries"][country_idx],
+        "year": cube["year"][mask],
+        "y": y,
+        "x": x,
+        "region": cube["regions"][country_idx],
+        "cell": cube["cell"][mask],
+        "occurrences": cube["count"][mask],
+    })
+
+def counts_by(cube, by, **ranges):
+    """
+    Occurrences summed by some of the columns of to_frame, e.g. counts_by(cube, ["country", "year"], species="Aedes aegypti")
+    """
+    return to_frame(cube, **ranges).groupby(by, as_index=False)["occurrences"].sum()
+
+def yearly_counts(cube, **ranges):
+    """
+    Occurrences by year, region and country, the table drawn by visualization.plot_yearly_counts
+    """
+    return counts_by(cube, ["year", "region", "country"], **ranges)
+
+def cell_points(cube, **ranges):
+    """
+    One row per non-empty grid cell with its center and occurrences, for visualization.world_map
+    """
+    return counts_by(cube, ["cell", "x", "y"], **ranges)
+
+
+def build_cubes(data_folder="../data", variants=None, grid=GRID, resolution=RESOLUTION, output_folder=None):
+    """
+    Create or update the cube of each dataset variant from the CSV files of the data folder,
+    only the rows not yet counted are added. The cubes are written to output_folder, data_folder if None.
+    """
+    from visualization import SPECIES, VARIANTS
+
+    for variant, pattern in (variants or VARIANTS).items():
+        path = os.path.join(output_folder or data_folder, CUBE_FILE.format(variant))
+        cube = load_cube(path) if os.path.exists(path) else empty_cube(grid, resolution)
+        total = 0
+        for name in SPECIES:
+            csv_path = os.path.join(data_folder, pattern.format(name))
+            if os.path.exists(csv_path):
+                cube, added = update_cube(cube, pd.read_csv(csv_path))
+                total += added
+        save_cube(cube, path)
+        print(f"{path}: {total} rows added, {int(cube['count'].sum())} occurrences in {len(cube['count'])} entries")
+
+
+if __name__ == "__main__":
+    build_cubes(*sys.argv[1:2])
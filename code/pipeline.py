@@ -0,0 +1,357 @@
+# general import
+import argparse
+import ast
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import textwrap
+import time
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+CACHE_FOLDER = "pipeline_cache"     # one folder per stage and cache key
+MANIFEST = "manifest.json"          # written last, a stage folder without it is incomplete
+CODE_FOLDER = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_CONFIG = {
+    # the PubMed search is cached like any stage, change refresh (e.g. to the date) to search again
+    "harvest": {"source": "pubmed", "paper_results": 1000, "pdf_folder": "pdf_folder", "refresh": ""},
+    "chunk": {},
+    "filter": {},
+    "extract": {"mode": "two_pass", "model": "meta-llama/Llama-3.2-3B-instruct", "device": None, "batch_size": 8,
+                "max_tokens": 2048, "overlap": 128},
+    "index": {},
+    "geocode": {},
+    "validate": {},
+    # the ground truth (validation_*.csv) is not produced by the pipeline, it is read from this folder
+    "plot": {"dpi": 300, "ground_truth_folder": "../data"},
+    "cube": {"grid": "latlon", "resolution": 1.0},
+}
+# files copied to the working folder by --export, under the names the notebooks read
+EXPORTS = {
+    "filter": ["input.jsonl", "dedup_provenance.jsonl"],
+    "extract": ["output_dataset.csv"],
+    "validate": ["updated_aegypti.csv", "updated_albopictus.csv"],
+}
+
+
+# Stages: each one reads the folders of its dependencies and writes its files to its own folder
+
+def run_harvest(inputs, folder, config):
+    if config["source"] == "pdf":
+        from text_extractor_utilities import process_pdfs
+        process_pdfs(config["pdf_folder"], os.path.join(folder, "texts"), workers=os.cpu_count() or 1)
+    else:
+        from pubmed_full_text import main
+        main(paper_results=config["paper_results"], output_file=os.path.join(folder, "articles.jsonl"),
+             metadata_file=os.path.join(folder, "metadata.jsonl"))
+
+def run_chunk(inputs, folder, config):
+    from jsonl_utilities import iter_records, write_jsonl
+    from text_proccessor_utilities import process_text_files
+
+    texts = os.path.join(inputs["harvest"], "texts")
+    if os.path.isdir(texts):
+        chunks = process_text_files(texts)
+    else:
+        # PMC articles are already split into paragraphs and tables by pubmed_full_text
+        chunks = iter_records(os.path.join(inputs["harvest"], "articles.jsonl"))
+    write_jsonl(chunks, os.path.join(folder, "chunks.jsonl"))
+
+def run_filter(inputs, folder, config):
+    from input_prep import prepare_input
+
+    prepare_input(os.path.join(inputs["chunk"], "chunks.jsonl"), os.path.join(folder, "input.jsonl"),
+                  os.path.join(folder, "dedup_provenance.jsonl"))
+
+def run_extract(inputs, folder, config):
+    import torch
+    from jsonl_utilities import iter_records
+    from llm_utilities import extract_data_batched, extract_data_single_pass
+    from result_store import open_store
+    from sharded_extraction import load_model
+    from text_proccessor_utilities import pack_chunks
+
+    device = config["device"] or ("cuda" if torch.cuda.is_available() else "cpu")
+    tokenizer, model = load_model(config["model"], device)
+    extract = extract_data_single_pass if config["mode"] == "single_pass" else extract_data_batched
+    chunks = pack_chunks(iter_records(os.path.join(inputs["filter"], "input.jsonl")), tokenizer,
+                         max_tokens=config["max_tokens"], overlap=config["overlap"])
+    # the result store is shared by the runs, chunks already extracted with the same prompts and model are skipped.
+    # Only the occurrences of the input windows are exported, in input order, so the output is determined by the inputs
+    extract(chunks, os.path.join(folder, "output_dataset.csv"), device, tokenizer, model,
+            batch_size=config["batch_size"], store=open_store())
+
+def run_index(inputs, folder, config):
+    import pandas as pd
+    from jsonl_utilities import iter_records
+    from validation_utilities import build_validation_index
+
+    sources = list(iter_records(os.path.join(inputs["filter"], "input.jsonl")))
+    sources += list(iter_records(os.path.join(inputs["filter"], "dedup_provenance.jsonl")))
+    countries = pd.read_csv(os.path.join(inputs["extract"], "output_dataset.csv"))["country"].dropna().unique()
+    for name, table in build_validation_index(sources, countries=countries).items():
+        table.to_csv(os.path.join(folder, f"{name}.csv"), index=False)
+
+def run_geocode(inputs, folder, config):
+    import pandas as pd
+    from jsonl_utilities import iter_records
+    from post_processing_utilities import clean_occurrences, add_coordinates
+
+    provenance = list(iter_records(os.path.join(inputs["filter"], "dedup_provenance.jsonl")))
+    df = clean_occurrences(pd.read_csv(os.path.join(inputs["extract"], "output_dataset.csv")), provenance)
+    add_coordinates(df).to_csv(os.path.join(folder, "geocoded.csv"), index=False)
+
+def run_validate(inputs, folder, config):
+    import pandas as pd
+    from post_processing_utilities import OUTPUT_COLUMNS, validate_species
+
+    index = {name: pd.read_csv(os.path.join(inputs["index"], f"{name}.csv"), dtype={"source_type": str})
+             for name in ("years", "countries", "species")}
+    for keyword, output in validate_species(pd.read_csv(os.path.join(inputs["geocode"], "geocoded.csv")), index).items():
+        output[OUTPUT_COLUMNS].to_csv(os.path.join(folder, f"updated_{keyword}.csv"), index=False)
+
+def run_plot(inputs, folder, config):
+    from visualization import render_all
+
+    # the pipeline output (updated_*.csv) is compared with the ground truth, the raw extraction variant is skipped
+    render_all(inputs["validate"], folder, dpi=config["dpi"], folders={"gt": config["ground_truth_folder"]},
+               compare=("gt", "updated"))
+
+def run_cube(inputs, folder, config):
+    from occurrence_cube import build_cubes
+
+    build_cubes(inputs["validate"], {"updated": "updated_{}.csv"}, config["grid"], config["resolution"], output_folder=folder)
+
+# dependencies, function and data files of each stage, the modules it uses are found from its imports (stage_modules)
+STAGES = {
+    "harvest": {"deps": [], "run": run_harvest, "data": []},
+    "chunk": {"deps": ["harvest"], "run": run_chunk, "data": []},
+    "filter": {"deps": ["chunk"], "run": run_filter, "data": []},
+    "extract": {"deps": ["filter"], "run": run_extract, "data": ["prompts.json"]},
+    "index": {"deps": ["filter", "extract"], "run": run_index, "data": []},
+    "geocode": {"deps": ["filter", "extract"], "run": run_geocode, "data": []},
+    "validate": {"deps": ["index", "geocode"], "run": run_validate, "data": []},
+    "plot": {"deps": ["validate"], "run": run_plot, "data": []},
+    "cube": {"deps": ["validate"], "run": run_cube, "data": []},
+}
+
+
+# Cache keys
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def local_imports(source):
+    """
+    Modules of the code folder imported by a source, at the top level or inside functions
+    """
+    modules = set()
+    for node in ast.walk(ast.parse(source)):
+        if isinstance(node, ast.Import):
+            names = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+            names = [node.module]
+        else:
+            continue
+        for module in names:
+            filename = module.split(".")[0] + ".py"
+            if os.path.exists(os.path.join(CODE_FOLDER, filename)):
+                modules.add(filename)
+    return modules
+
+def stage_modules(name):
+    """
+    Modules of the code folder a stage depends on: those imported by its function and, recursively, by these modules
+    """
+    modules = set()
+    todo = local_imports(textwrap.dedent(inspect.getsource(STAGES[name]["run"])))
+    while todo:
+        filename = todo.pop()
+        modules.add(filename)
+        with open(os.path.join(CODE_FOLDER, filename), "r", encoding="utf-8") as f:
+            todo |= local_imports(f.read()) - modules
+    return sorted(modules)
+
+def code_version(name):
+    """
+    Hash of the source of a stage: its function, the modules it imports and its data files
+    """
+    parts = [inspect.getsource(STAGES[name]["run"])]
+    paths = [os.path.join(CODE_FOLDER, filename) for filename in stage_modules(name) + STAGES[name]["data"]]
+    parts += [file_hash(path) if os.path.exists(path) else "" for path in paths]
+    return hashlib.sha256(json.dumps(parts).encode("utf-8")).hexdigest()
+
+def external_inputs(name, config):
+    # inputs read from outside the cache: the PDF folder listing, the PubMed query or the ground truth files
+    if name == "plot":
+        folder = config["ground_truth_folder"]
+        return {f: file_hash(os.path.join(folder, f)) for f in sorted(os.listdir(folder))
+                if f.startswith("validation_") and f.endswith(".csv")} if os.path.isdir(folder) else {}
+    if name != "harvest":
+        return None
+    if config["source"] == "pdf":
+        folder = config["pdf_folder"]
+        return sorted((f, os.path.getsize(os.path.join(folder, f)), os.path.getmtime(os.path.join(folder, f)))
+                      for f in os.listdir(folder)) if os.path.isdir(folder) else []
+    with open("prompts.json", "r") as f:
+        return json.load(f)["pubmed_search"]
+
+def read_manifest(folder):
+    path = os.path.join(folder, MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+def stage_key(name, config, dep_manifests):
+    """
+    Cache key of a stage: hash of its code version, its configuration, its external inputs and the content
+    hashes of the files of its dependencies, so that a dependency rerun with the same output does not invalidate it
+    """
+    key = {
+        "stage": name,
+        "code": code_version(name),
+        "config": config[name],
+        "external": external_inputs(name, config[name]),
+        "inputs": {dep: dep_manifests[dep]["files"] for dep in STAGES[name]["deps"]},
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:16]
+
+def stage_folder(name, key, cache_folder=CACHE_FOLDER):
+    return os.path.join(cache_folder, name, key)
+
+
+# Execution
+
+def execute_stage(name, run, inputs, folder, config):
+    """
+    Run a stage in a temporary folder renamed once its manifest is written, an interrupted stage is rerun
+    """
+    tmp_folder = folder + ".tmp"
+    shutil.rmtree(tmp_folder, ignore_errors=True)
+    os.makedirs(tmp_folder)
+    start = time.time()
+    run(inputs, tmp_folder, config)
+    files = {}
+    for root, _, filenames in os.walk(tmp_folder):
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            files[os.path.relpath(path, tmp_folder)] = file_hash(path)
+    manifest = {"stage": name, "files": dict(sorted(files.items())), "seconds": round(time.time() - start, 1), "created": time.time()}
+    with open(os.path.join(tmp_folder, MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=1)
+    shutil.rmtree(folder, ignore_errors=True)
+    os.replace(tmp_folder, folder)
+    return manifest
+
+def upstream(targets):
+    """
+    The targets and all the stages they depend on, in the order of STAGES
+    """
+    needed = set()
+    todo = list(targets)
+    while todo:
+        name = todo.pop()
+        if name not in needed:
+            needed.add(name)
+            todo.extend(STAGES[name]["deps"])
+    return [name for name in STAGES if name in needed]
+
+def run_pipeline(targets=None, config=None, force=(), workers=2, cache_folder=CACHE_FOLDER, export=False):
+    """
+    Run the stages needed by the targets. A stage whose cache key (code, configuration and inputs) has a complete
+    folder in the cache is not run again. Stages whose dependencies are done run in parallel in separate processes.
+
+    @params:
+        - targets: stages to bring up to date, all of them if None
+        - config: configuration by stage, merged into DEFAULT_CONFIG
+        - force: stages run even if they are cached
+        - workers: maximum number of stages running at once
+        - cache_folder: folder of the stage outputs
+        - export: copy the outputs to the working folder under the names the notebooks read (see EXPORTS)
+
+    @returns:
+        - a dictionary stage -> folder of its outputs
+    """
+    config = {name: {**DEFAULT_CONFIG[name], **(config or {}).get(name, {})} for name in STAGES}
+    pending = upstream(targets or list(STAGES))
+    manifests, folders, running = {}, {}, {}
+    context = mp.get_context("spawn")
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        while pending or running:
+            for name in [name for name in pending if all(dep in manifests for dep in STAGES[name]["deps"])]:
+                pending.remove(name)
+                folder = stage_folder(name, stage_key(name, config, manifests), cache_folder)
+                folders[name] = folder
+                manifest = read_manifest(folder)
+                if manifest is not None and name not in force:
+                    print(f"[{name}] cached in {folder}")
+                    manifests[name] = manifest
+                    continue
+                print(f"[{name}] running -> {folder}")
+                inputs = {dep: folders[dep] for dep in STAGES[name]["deps"]}
+                running[executor.submit(execute_stage, name, STAGES[name]["run"], inputs, folder, config[name])] = name
+            if not running:
+                # only cached stages were found, their dependents are now ready
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                manifests[name] = future.result()
+                print(f"[{name}] done in {manifests[name]['seconds']}s")
+
+    if export:
+        for name, filenames in EXPORTS.items():
+            for filename in filenames:
+                if name in folders and os.path.exists(os.path.join(folders[name], filename)):
+                    shutil.copyfile(os.path.join(folders[name], filename), filename)
+    return folders
+
+def pipeline_status(config=None, cache_folder=CACHE_FOLDER):
+    """
+    Print, for each stage, whether its outputs for the current code, configuration and inputs are cached
+    """
+    config = {name: {**DEFAULT_CONFIG[name], **(config or {}).get(name, {})} for name in STAGES}
+    manifests = {}
+    for name in STAGES:
+        if not all(dep in manifests for dep in STAGES[name]["deps"]):
+            print(f"{name}: waiting for {', '.join(dep for dep in STAGES[name]['deps'] if dep not in manifests)}")
+            continue
+        folder = stage_folder(name, stage_key(name, config, manifests), cache_folder)
+        manifest = read_manifest(folder)
+        if manifest is None:
+            print(f"{name}: to run ({folder})")
+        else:
+            manifests[name] = manifest
+            print(f"{name}: cached ({folder})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pipeline runner: harvest -> chunk -> filter -> extract -> index/geocode -> validate -> plot/cube")
+    parser.add_argument("command", choices=["run", "status"])
+    parser.add_argument("targets", nargs="*", help=f"stages to bring up to date ({', '.join(STAGES)}), all by default")
+    parser.add_argument("--config", default=None, help="JSON file with the configuration of some stages, e.g. {\"extract\": {\"mode\": \"single_pass\"}}")
+    parser.add_argument("--force", nargs="*", default=[], choices=list(STAGES), help="stages run even if they are cached")
+    parser.add_argument("--workers", type=int, default=2, help="stages running at once")
+    parser.add_argument("--cache", default=CACHE_FOLDER)
+    parser.add_argument("--export", action="store_true", help="copy input.jsonl, output_dataset.csv and updated_*.csv to the working folder")
+    args = parser.parse_args()
+    unknown = [name for name in args.targets if name not in STAGES]
+    if unknown:
+        parser.error(f"unknown stages: {', '.join(unknown)}")
+
+    config = None
+    if args.config:
+        with open(args.config, "r") as f:
+            config = json.load(f)
+    if args.command == "run":
+        run_pipeline(args.targets or None, config, args.force, args.workers, args.cache, args.export)
+    else:
+        pipeline_status(config, args.cache)
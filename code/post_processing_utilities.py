@@ -0,0 +1,92 @@
+# general import
+from datetime import datetime
+from country_utilities import is_valid_country_column
+from dedup_utilities import credit_duplicates
+from geocoding_utilities import get_coordinates
+from validation_utilities import validate_occurrences
+
+SPECIES = {"aegypti": "Aedes aegypti", "albopictus": "Aedes albopictus"}
+MAX_LOCATION_WORDS = 9
+OUTPUT_COLUMNS = ["vector", "source_type", "country", "year", "y", "x"]
+CURRENT_YEAR = datetime.now().year
+
+
+def filter_uppercase_words(text):
+    words = text.split()
+    filtered_words = [word for word in words if word[0].isupper()]
+    return ' '.join(filtered_words)
+
+def is_valid_year(value):
+    try:
+        year = int(value)
+        return 1000 <= year <= CURRENT_YEAR
+    except:
+        return False
+
+def process_year_column(df, col_name):
+    def process_year(x):
+        if is_valid_year(x):
+            return int(x)
+        try:
+            int(x)
+            return 0
+        except (ValueError, TypeError):
+            return "Not a year"
+
+    df[col_name] = df[col_name].apply(process_year)
+    return df
+
+def clean_occurrences(df, provenance=()):
+    """
+    Keep the occurrences of the two species with a usable location, year and country
+
+    @params:
+        - df: the extracted occurrences (output_dataset.csv)
+        - provenance: records of the chunks dropped as duplicates, their documents are credited (see dedup_utilities)
+
+    @returns:
+        - the cleaned DataFrame
+    """
+    df = df[df["vector"].isin(list(SPECIES.values()))].copy()
+    # occurrences of a kept chunk are also credited to the documents of its dropped duplicates
+    df = credit_duplicates(df, list(provenance))
+
+    df['location'] = df['location'].apply(filter_uppercase_words)
+    df = df[df['location'].str.replace(',', '').str.split().str.len() <= MAX_LOCATION_WORDS]
+
+    df = process_year_column(df, "year")
+    df = df[df["year"]!="Not a year"]
+
+    # unique country names are resolved once (cached in country_cache.json), unknown names are reported together
+    df['is_valid_country'] = is_valid_country_column(df['country'])
+    return df[df["is_valid_country"]==True]
+
+def add_coordinates(df, **kwargs):
+    """
+    Geocode the locations (see geocoding_utilities.geocode_locations for the options),
+    rows that could not be geocoded and duplicated rows are dropped
+    """
+    # cached in geocode_cache.sqlite, resolved offline from the GeoNames dump (cities15000.txt) when possible
+    location_coords = get_coordinates(df, **kwargs)
+    df['y'] = df['location'].map(lambda x: location_coords.get(x, {}).get('latitude'))
+    df['x'] = df['location'].map(lambda x: location_coords.get(x, {}).get('longitude'))
+    df = df.drop_duplicates()
+    return df.dropna()
+
+def validate_species(df, validation_index):
+    """
+    Split the occurrences by species and keep those whose year, country and species are mentioned in their document
+
+    @params:
+        - df: the geocoded occurrences
+        - validation_index: the index of the source texts (validation_utilities.build_validation_index)
+
+    @returns:
+        - a dictionary species keyword -> validated occurrences
+    """
+    validated = {}
+    for keyword, vector in SPECIES.items():
+        output = df[df["vector"]==vector].copy()
+        output["valid"] = validate_occurrences(output, validation_index, species=keyword)
+        validated[keyword] = output[output["valid"]==True]
+    return validated
@@ -1,10 +1,17 @@
 from Bio import Entrez
 import requests
+from requests.adapters import HTTPAdapter
 import lxml.etree as ET
 import re
+import io
 import json
 import os
 import time
+import hashlib
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from jsonl_utilities import write_jsonl
 
 
 with open("authentification.json","r") as f:
@@ -17,6 +24,48 @@ Entrez.email = AUTH_KEYS["email"]
 Entrez.api_key = AUTH_KEYS["ncbi_api_key"]
 query = PROMPTS["pubmed_search"]
 
+EFETCH_URL = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi"
+BATCH_SIZE = 50     # PMCIDs per efetch request
+MAX_WORKERS = 4     # concurrent efetch requests
+MAX_RETRIES = 3
+CITATION_PATTERN = re.compile(r'\[\d+(,\d+)*\]')
+CACHE_FOLDER = "pmc_cache"
+MANIFEST_FILE = "manifest.jsonl"
+PARSED_FILE = "parsed.jsonl"    # metadata and chunks of each parsed article, appended once when it is fetched
+OUTPUT_FILE = "input.jsonl"    # use a .gz or .zst extension to compress
+METADATA_FILE = "metadata.jsonl"
+
+class TokenBucket:
+    """
+    Thread-safe token bucket used to stay under the NCBI request rate limit
+    (3 requests/s without API key, 10 requests/s with one).
+
+    @params:
+        - rate: number of tokens added per second
+        - capacity: maximum number of tokens that can be accumulated
+    """
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Block until a token is available and consume it
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
 def search_pmc_open_access(query, paper_results):
     """
     Search PMC for open-access articles and return PMCIDs.
@@ -42,9 +91,148 @@ def fetch_article_xml(pmcid):
         return response.text
     return None
 
+def create_session(pool_size=MAX_WORKERS):
+    """
+    Create an HTTP session whose connections are pooled and reused across requests.
+
+    @params:
+        - pool_size: maximum number of connections kept alive
+
+    @returns:
+        - a requests.Session
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def fetch_articles_xml(pmcids, session, bucket, base_url=EFETCH_URL):
+    """
+    Fetch a <pmc-articleset> containing several articles with a single efetch request.
+
+    @params:
+        - pmcids: list of PMCIDs
+        - session: the pooled requests.Session
+        - bucket: TokenBucket shared by every worker
+        - base_url: the efetch endpoint
+
+    @returns:
+        - the raw XML response as bytes, None if the request failed
+    """
+    params = {"db": "pmc", "id": ",".join(pmcids), "retmode": "xml"}
+    if Entrez.api_key is not None:
+        params["api_key"] = Entrez.api_key
+    if Entrez.email is not None:
+        params["email"] = Entrez.email
+
+    for attempt in range(MAX_RETRIES):
+        bucket.acquire()
+        try:
+            # POST so that long id lists do not hit URL length limits
+            response = session.post(base_url, data=params, timeout=60)
+        except requests.RequestException as e:
+            print(f"Request failed for batch starting at PMCID {pmcids[0]}: {e}")
+            time.sleep(2 ** attempt)
+            continue
+        if response.status_code == 200:
+            return response.content
+        if response.status_code in (429, 500, 502, 503, 504):
+            time.sleep(2 ** attempt)
+            continue
+        break
+    return None
+
+def article_pmcid(article):
+    """
+    Return the PMCID (digits only) of an <article> element.
+    """
+    for id_type in ("pmcid", "pmc"):
+        pmcid = article.find(f".//article-id[@pub-id-type='{id_type}']")
+        if pmcid is not None and pmcid.text:
+            return pmcid.text.strip().replace("PMC", "")
+    return None
+
+def split_article_set(xml_content):
+    """
+    Split an efetch <pmc-articleset> response into per-article XML documents.
+    The response is parsed incrementally and each article is released once serialized.
+
+    @params:
+        - xml_content: the raw efetch response (bytes or str)
+
+    @returns:
+        - a list of (pmcid, article_xml) tuples
+    """
+    if isinstance(xml_content, str):
+        xml_content = xml_content.encode("utf-8")
+    articles = []
+    for _, article in ET.iterparse(io.BytesIO(xml_content), events=("end",), tag="article"):
+        articles.append((article_pmcid(article), ET.tostring(article, encoding="unicode")))
+        release_element(article)
+    return articles
+
+def release_element(elem):
+    """
+    Free an element already processed by iterparse, together with its preceding siblings.
+    """
+    elem.clear()
+    parent = elem.getparent()
+    if parent is not None:
+        while elem.getprevious() is not None:
+            del parent[0]
+
+def harvest_articles(pmc_ids, batch_size=BATCH_SIZE, max_workers=MAX_WORKERS, requests_per_second=None, base_url=EFETCH_URL):
+    """
+    Fetch articles with batched efetch requests run concurrently over a pooled session.
+    Batches are yielded in the order of pmc_ids so that the numbering of articles stays stable.
+
+    @params:
+        - pmc_ids: list of PMCIDs to fetch
+        - batch_size: number of PMCIDs per efetch request
+        - max_workers: number of requests in flight
+        - requests_per_second: rate limit, defaults to the NCBI limit (3/s, 10/s with an API key)
+        - base_url: the efetch endpoint
+
+    @returns:
+        - a generator of (pmcid, article_xml) tuples, article_xml is None when the article could not be fetched
+    """
+    if requests_per_second is None:
+        requests_per_second = 3 if Entrez.api_key is None else 10
+    bucket = TokenBucket(requests_per_second)
+    batches = [pmc_ids[i:i + batch_size] for i in range(0, len(pmc_ids), batch_size)]
+
+    with create_session(max_workers) as session, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        batch_iter = iter(batches)
+        # keep a bounded number of batches in flight
+        for batch in batch_iter:
+            pending.append((batch, executor.submit(fetch_articles_xml, batch, session, bucket, base_url)))
+            if len(pending) >= 2 * max_workers:
+                break
+
+        while pending:
+            batch, future = pending.popleft()
+            next_batch = next(batch_iter, None)
+            if next_batch is not None:
+                pending.append((next_batch, executor.submit(fetch_articles_xml, next_batch, session, bucket, base_url)))
+
+            xml_content = future.result()
+            articles = {}
+            if xml_content:
+                try:
+                    articles = dict(split_article_set(xml_content))
+                except ET.XMLSyntaxError as e:
+                    print(f"Failed to parse batch starting at PMCID {batch[0]}: {e}")
+            for pmcid in batch:
+                yield pmcid, articles.get(str(pmcid).replace("PMC", ""))
+
 def extract_metadata_and_paragraphs(xml_content, id_counter):
     """
     Extract metadata, paragraphs, and tables from PMC XML.
+
+    @returns:
+        - a (metadata, chunks) tuple, None if the article has no content
     """
     try:
         root = ET.fromstring(xml_content.encode('utf-8'))
@@ -116,21 +304,336 @@ def extract_metadata_and_paragraphs(xml_content, id_counter):
         if not content_objects:  
             return None
         
-        article_objects = []
-        for content in content_objects:
-            article_objects.append({
-                "source_type": str(id_counter),
-                "Author": author_text,
-                "Title": title_text,
-                "URL": url_text,
-                "Journal": journal_text,
-                "DOI": doi_text,
-                "text": content["text"]
-            })
+        # metadata is stored once per article, chunks only reference it through source_type
+        metadata = {
+            "source_type": str(id_counter),
+            "Author": author_text,
+            "Title": title_text,
+            "URL": url_text,
+            "Journal": journal_text,
+            "DOI": doi_text
+        }
+        chunks = [{"source_type": str(id_counter), "text": content["text"]} for content in content_objects]
         
-        return article_objects
+        return metadata, chunks
+    except ET.ParseError:
+        return None
+
+def clean_text(text):
+    """
+    Remove citation markers and collapse whitespace, same result as the two re.sub calls
+    of extract_metadata_and_paragraphs but without running the regex engine when unneeded.
+    """
+    if "[" in text:
+        text = CITATION_PATTERN.sub('', text)
+    parts = text.split()
+    if not parts:
+        return " " if text else ""
+    collapsed = " ".join(parts)
+    if text[0].isspace():
+        collapsed = " " + collapsed
+    if text[-1].isspace():
+        collapsed += " "
+    return collapsed
+
+def element_text(elem):
+    # serialising in text mode runs in C, unlike joining itertext()
+    return ET.tostring(elem, method="text", encoding="unicode", with_tail=False).strip()
+
+def extract_authors(elem):
+    """
+    "Given-names Surname" of the author contribs of an element, in document order.
+    """
+    authors = []
+    for contrib in elem.iterfind(".//contrib[@contrib-type='author']//name"):
+        surname = contrib.find("surname")
+        given_names = contrib.find("given-names")
+        if surname is not None and given_names is not None:
+            authors.append(f"{given_names.text} {surname.text}")
+    return authors
+
+def join_authors(authors):
+    return ", ".join(authors) if authors else "No authors available"
+
+def extract_front_metadata(front):
+    """
+    Extract title, authors, PMCID, journal and DOI from the <front> of an article.
+    """
+    title = front.find(".//article-title")
+    title_text = element_text(title) if title is not None else "No title available"
+    
+    authors = extract_authors(front)
+    
+    pmcid = front.find(".//article-id[@pub-id-type='pmcid']")
+    pmcid_text = pmcid.text if pmcid is not None else "Unknown"
+    
+    journal = front.find(".//journal-title")
+    journal_text = element_text(journal) if journal is not None else "No journal available"
+    
+    doi = front.find(".//article-id[@pub-id-type='doi']")
+    doi_text = doi.text if doi is not None else "No DOI available"
+    
+    return {
+        "Author": join_authors(authors),
+        "Title": title_text,
+        "URL": f"https://www.ncbi.nlm.nih.gov/pmc/articles/PMC{pmcid_text}/",
+        "Journal": journal_text,
+        "DOI": doi_text
+    }
+
+def extract_table_text(table_wrap):
+    """
+    Flatten a <table-wrap> into "caption; Row: cell, cell; ..." text.
+    """
+    table_text_parts = []
+    caption = table_wrap.find(".//caption")
+    if caption is not None:
+        caption_text = element_text(caption)
+        if caption_text:
+            table_text_parts.append(caption_text)
+    
+    table = table_wrap.find(".//table")
+    if table is not None:
+        for row in table.iter("tr"):
+            row_cells = [text for text in (element_text(cell) for cell in row.iter("td", "th")) if text]
+            if row_cells:
+                table_text_parts.append("Row: " + ", ".join(row_cells))
+    
+    if not table_text_parts:
+        return None
+    return clean_text("; ".join(table_text_parts))
+
+def in_main_body(elem, article):
+    body = next(elem.iterancestors("body"), None)
+    return body is not None and body.getparent() is article
+
+def iter_parse_articles(source):
+    """
+    Stream-parse PMC XML (a single <article> or a whole <pmc-articleset>) with iterparse.
+    Paragraphs and tables of the main <body> are collected in a single pass and elements
+    are cleared as soon as they are processed, so memory stays bounded by one article.
+    The output is the same as extract_metadata_and_paragraphs: paragraphs first, then tables,
+    and the authors of the sub-articles (e.g. reviewers and authors of a reply) after those of the <front>.
+
+    @params:
+        - source: a path, a binary file object, or the XML as bytes or str
+
+    @returns:
+        - a generator of (pmcid, metadata, content_texts) tuples, one per article
+    """
+    if isinstance(source, str) and source.lstrip().startswith("<"):
+        source = source.encode("utf-8")
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+
+    # only the elements of interest are reported, the rest of the tree is built in C
+    events = ET.iterparse(source, events=("start", "end"), tag=("article", "front", "body", "back", "sub-article", "p", "table-wrap"))
+    article = None
+    for event, elem in events:
+        tag = elem.tag
+        if event == "start":
+            if tag == "article":
+                article, metadata, pmcid = elem, None, None
+                paragraphs, tables, authors = [], [], []
+            continue
+        if article is None:
+            continue
+
+        if tag == "p" or tag == "table-wrap":
+            if not in_main_body(elem, article):
+                continue
+            if tag == "p":
+                text = clean_text(element_text(elem)) if elem.text else None
+                # nested paragraphs end first, insert the outer one before them to keep document order
+                nested = sum(1 for _ in elem.iterdescendants("p"))
+                paragraphs.insert(len(paragraphs) - nested, text)
+            else:
+                nested = sum(1 for _ in elem.iterdescendants("table-wrap"))
+                tables.insert(len(tables) - nested, extract_table_text(elem))
+            if next(elem.iterancestors("p", "table-wrap"), None) is None:
+                elem.clear()
+        elif tag == "article":
+            if metadata is None:
+                metadata = extract_front_metadata(ET.Element("front"))
+            metadata["Author"] = join_authors(authors)
+            content = [text for text in paragraphs if text] + [text for text in tables if text]
+            yield pmcid, metadata, content
+            release_element(elem)
+            article = None
+        elif elem.getparent() is not article:
+            continue
+        elif tag == "front":
+            metadata = extract_front_metadata(elem)
+            pmcid = article_pmcid(elem)
+            authors += extract_authors(elem)
+            elem.clear()
+        else:
+            # body, back and sub-articles, contribs are collected in document order before clearing
+            authors += extract_authors(elem)
+            elem.clear()
+
+def parse_article(xml_content, id_counter):
+    """
+    Streaming replacement of extract_metadata_and_paragraphs.
+
+    @params:
+        - xml_content: the article XML
+        - id_counter: the source_type given to the article
+
+    @returns:
+        - a (metadata, chunks) tuple, None if the article has no content
+    """
+    try:
+        for _, metadata, content in iter_parse_articles(xml_content):
+            if not content:
+                return None
+            metadata = {"source_type": str(id_counter), **metadata}
+            chunks = [{"source_type": str(id_counter), "text": text} for text in content]
+            return metadata, chunks
     except ET.ParseError:
         return None
+    return None
+
+def load_manifest(cache_folder=CACHE_FOLDER):
+    """
+    Load the manifest of already harvested articles.
+    The manifest is an append-only JSON Lines file, the last entry of a PMCID wins.
+
+    @params:
+        - cache_folder: folder of the article cache
+
+    @returns:
+        - a dictionary PMCID -> manifest entry
+    """
+    manifest = {}
+    manifest_path = os.path.join(cache_folder, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return manifest
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # last line of an interrupted run
+                continue
+            manifest[entry["pmcid"]] = entry
+    return manifest
+
+def append_manifest(entry, cache_folder=CACHE_FOLDER):
+    """
+    Durably append an entry to the manifest.
+    """
+    os.makedirs(cache_folder, exist_ok=True)
+    with open(os.path.join(cache_folder, MANIFEST_FILE), "a", encoding="utf-8") as f:
+        f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+def article_cache_path(digest, cache_folder=CACHE_FOLDER):
+    return os.path.join(cache_folder, "xml", digest[:2], f"{digest}.xml")
+
+def store_article_xml(xml_content, cache_folder=CACHE_FOLDER):
+    """
+    Store the raw XML of an article in the content-addressed cache.
+
+    @params:
+        - xml_content: the article XML
+        - cache_folder: folder of the article cache
+
+    @returns:
+        - the SHA-256 digest under which the XML is stored
+    """
+    data = xml_content.encode("utf-8")
+    digest = hashlib.sha256(data).hexdigest()
+    path = article_cache_path(digest, cache_folder)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    return digest
+
+def load_article_xml(digest, cache_folder=CACHE_FOLDER):
+    """
+    Read the raw XML of an article from the cache, None if missing.
+    """
+    path = article_cache_path(digest, cache_folder)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read()
+
+def iter_parsed_records(cache_folder=CACHE_FOLDER):
+    """
+    Read the parsed articles of the cache, in the order they were appended
+    """
+    path = os.path.join(cache_folder, PARSED_FILE)
+    if not os.path.exists(path):
+        return
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                # last line of an interrupted run
+                continue
+
+def append_parsed_record(record, cache_folder=CACHE_FOLDER):
+    """
+    Durably append a parsed article (pmcid, sha256, source_type, metadata and chunks) to the cache.
+    """
+    os.makedirs(cache_folder, exist_ok=True)
+    with open(os.path.join(cache_folder, PARSED_FILE), "a", encoding="utf-8") as f:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+def parsed_record(pmcid, digest, extracted):
+    article_metadata, chunks = extracted
+    return {"pmcid": str(pmcid), "sha256": digest, "source_type": article_metadata["source_type"],
+            "metadata": article_metadata, "chunks": chunks}
+
+def iter_cached_articles(manifest, cache_folder=CACHE_FOLDER, metadata=None):
+    """
+    Rebuild the chunks of every parsed article from the cache. The parsed records are read back,
+    only the articles cached before they were recorded are parsed again from their XML (once, their
+    record is appended). Articles are yielded in the order they were harvested, one at a time.
+
+    @params:
+        - manifest: the manifest of harvested articles
+        - cache_folder: folder of the article cache
+        - metadata: optional list to which the metadata record of each article is appended
+
+    @returns:
+        - a generator of chunks
+    """
+    done = set()
+    for record in iter_parsed_records(cache_folder):
+        entry = manifest.get(record["pmcid"])
+        # records of an interrupted run are only valid once their manifest entry is written
+        if (entry is None or record["pmcid"] in done or entry["sha256"] != record["sha256"]
+                or entry.get("source_type") != record["source_type"]):
+            continue
+        done.add(record["pmcid"])
+        if metadata is not None:
+            metadata.append(record["metadata"])
+        yield from record["chunks"]
+
+    missing = sorted((e for e in manifest.values() if e.get("source_type") and e["pmcid"] not in done),
+                     key=lambda e: int(e["source_type"]))
+    for entry in missing:
+        xml_content = load_article_xml(entry["sha256"], cache_folder)
+        if xml_content is None:
+            print(f"Cached XML missing for PMCID {entry['pmcid']}")
+            continue
+        extracted = parse_article(xml_content, entry["source_type"])
+        if extracted:
+            append_parsed_record(parsed_record(entry["pmcid"], entry["sha256"], extracted), cache_folder)
+            article_metadata, chunks = extracted
+            if metadata is not None:
+                metadata.append(article_metadata)
+            yield from chunks
 
 def save_articles_json(articles, output_file="input.json"):
     """
@@ -139,9 +642,17 @@ def save_articles_json(articles, output_file="input.json"):
     with open(output_file, "w", encoding="utf-8") as f:
         json.dump(articles, f, ensure_ascii=False, indent=2)
 
-def main():
-    paper_results = 1000 
-    delay = 0.34 if Entrez.api_key is None else 0.1
+def save_articles_jsonl(articles, output_file=OUTPUT_FILE):
+    """
+    Stream articles to a JSON Lines file, one object per line.
+
+    @returns:
+        - the number of objects written
+    """
+    return write_jsonl(articles, output_file)
+
+def main(batch_size=BATCH_SIZE, max_workers=MAX_WORKERS, cache_folder=CACHE_FOLDER, paper_results=1000,
+         output_file=OUTPUT_FILE, metadata_file=METADATA_FILE):
     
     try:
         pmc_ids = search_pmc_open_access(query, paper_results)
@@ -153,26 +664,37 @@ def main():
         print("No open-access articles found.")
         return
     
-    articles = []
-    id_counter = 1
+    # Only fetch the articles that are not in the cache yet
+    manifest = load_manifest(cache_folder)
+    new_ids = [pmcid for pmcid in pmc_ids if str(pmcid) not in manifest]
+    print(f"{len(pmc_ids) - len(new_ids)} articles already cached, {len(new_ids)} to fetch")
+    id_counter = max((int(e["source_type"]) for e in manifest.values() if e.get("source_type")), default=0) + 1
     
-    for i, pmcid in enumerate(pmc_ids, 1):
-        print(f"Processing article {i}/{len(pmc_ids)}: PMCID {pmcid}")
-        xml_content = fetch_article_xml(pmcid)
+    harvested = harvest_articles(new_ids, batch_size=batch_size, max_workers=max_workers)
+    for i, (pmcid, xml_content) in enumerate(harvested, 1):
+        print(f"Processing article {i}/{len(new_ids)}: PMCID {pmcid}")
         if xml_content:
-            article_objects = extract_metadata_and_paragraphs(xml_content, id_counter)
-            if article_objects: 
-                articles.extend(article_objects)
+            digest = store_article_xml(xml_content, cache_folder)
+            extracted = parse_article(xml_content, id_counter)
+            entry = {"pmcid": str(pmcid), "sha256": digest, "source_type": None, "objects": 0}
+            if extracted: 
+                chunks = extracted[1]
+                # parsed once, input.jsonl is rebuilt from the parsed records
+                append_parsed_record(parsed_record(pmcid, digest, extracted), cache_folder)
+                entry.update(source_type=str(id_counter), objects=len(chunks))
                 id_counter += 1
-                print(f"Successfully processed PMCID {pmcid} with {len(article_objects)} objects")
+                print(f"Successfully processed PMCID {pmcid} with {len(chunks)} objects")
             else:
                 print(f"Failed to extract content for PMCID {pmcid}")
+            append_manifest(entry, cache_folder)
         else:
             print(f"Failed to fetch XML for PMCID {pmcid}")
-        time.sleep(delay)  
     
-    if articles:
-        save_articles_json(articles)
+    metadata = []
+    written = save_articles_jsonl(iter_cached_articles(load_manifest(cache_folder), cache_folder, metadata), output_file)
+    write_jsonl(metadata, metadata_file)
+    if written:
+        print(f"Saved {written} objects to {output_file} and {len(metadata)} articles to {metadata_file}")
     else:
         print("No articles were successfully processed.")
 
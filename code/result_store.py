@@ -0,0 +1,102 @@
+# general import
+import hashlib
+import json
+import sqlite3
+import time
+
+RESULT_DB = "extraction_results.sqlite"
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def prompt_hash(*parts):
+    """
+    Hash of everything that changes the output of an extraction for a given chunk:
+    the prompt templates and the generation parameters
+    """
+    return text_hash(json.dumps(parts, sort_keys=True, ensure_ascii=False))
+
+def chunk_key(chunk):
+    return str(chunk["source_type"]), text_hash(chunk["text"])
+
+def open_store(path=RESULT_DB, timeout=60.0, wal=True):
+    """
+    Open (or create) the SQLite result store.
+    One row per processed chunk, keyed by (source_type, chunk hash, prompt hash, model name),
+    holding the occurrences extracted from it (possibly none).
+
+    @params:
+        - path: path of the database
+        - timeout: seconds to wait for a lock held by another process
+        - wal: use write-ahead logging, not supported on network filesystems
+
+    @returns:
+        - a sqlite3 connection
+    """
+    conn = sqlite3.connect(path, timeout=timeout)
+    if wal:
+        conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS results (
+            source_type TEXT NOT NULL,
+            chunk_hash TEXT NOT NULL,
+            prompt_hash TEXT NOT NULL,
+            model TEXT NOT NULL,
+            occurrences TEXT NOT NULL,
+            created REAL NOT NULL,
+            PRIMARY KEY (source_type, chunk_hash, prompt_hash, model)
+        )""")
+    conn.commit()
+    return conn
+
+def is_completed(conn, chunk, prompt_hash, model):
+    """
+    Whether a chunk was already processed with this prompt and model (primary key lookup)
+    """
+    row = conn.execute("SELECT 1 FROM results WHERE source_type = ? AND chunk_hash = ? AND prompt_hash = ? AND model = ?",
+                       (*chunk_key(chunk), prompt_hash, model)).fetchone()
+    return row is not None
+
+def save_results(conn, results, prompt_hash, model):
+    """
+    Record the occurrences of a batch of chunks in a single transaction
+
+    @params:
+        - conn: the store
+        - results: list of (chunk, occurrences) tuples
+        - prompt_hash, model: the extraction the results come from
+    """
+    now = time.time()
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)",
+            [(*chunk_key(chunk), prompt_hash, model, json.dumps(occurrences, ensure_ascii=False), now) for chunk, occurrences in results])
+
+def iter_results(conn, prompt_hash, model, keys=None):
+    """
+    Occurrences stored for a prompt and model, in processing order
+
+    @params:
+        - conn: the store
+        - prompt_hash, model: the extraction the results come from
+        - keys: optional list of chunk keys (chunk_key), only the occurrences of these chunks are returned, in the
+          order of the list. The store is shared by the runs, without keys the chunks of every earlier input are included
+
+    @returns:
+        - a generator of occurrence dictionaries
+    """
+    rows = conn.execute("SELECT source_type, chunk_hash, occurrences FROM results WHERE prompt_hash = ? AND model = ? "
+                        "ORDER BY created, rowid", (prompt_hash, model))
+    if keys is None:
+        for _, _, occurrences in rows:
+            yield from json.loads(occurrences)
+        return
+    # the output only depends on the input chunks, not on the order they were processed in (here or by earlier runs)
+    positions = {}
+    for key in keys:
+        positions.setdefault(key, len(positions))
+    found = sorted((positions[(source_type, chunk_hash)], occurrences) for source_type, chunk_hash, occurrences in rows
+                   if (source_type, chunk_hash) in positions)
+    for _, occurrences in found:
+        yield from json.loads(occurrences)
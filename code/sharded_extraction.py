@@ -0,0 +1,254 @@
+# general import
+import argparse
+import hashlib
+import json
+import os
+import socket
+import sqlite3
+import time
+import multiprocessing as mp
+from itertools import groupby
+
+from jsonl_utilities import iter_records
+from result_store import RESULT_DB, chunk_key, open_store
+
+QUEUE_DB = "extraction_queue.sqlite"
+MODEL_NAME = "meta-llama/Llama-3.2-3B-instruct"
+TASK_SIZE = 16          # chunks per task, documents are never split across tasks
+LEASE_SECONDS = 3600    # a running task whose lease was not renewed for this delay can be taken by another worker
+MODES = {"two_pass": ("summary_prompt", "structuration_prompt"), "single_pass": ("extraction_prompt",)}
+
+
+# Queue
+
+def open_queue(path=QUEUE_DB, timeout=60.0, wal=True):
+    """
+    Open (or create) the SQLite task queue shared by the workers
+
+    @params:
+        - path: path of the database, on a filesystem shared by all the nodes
+        - timeout: seconds to wait for a lock held by another worker
+        - wal: use write-ahead logging, not supported on network filesystems
+    """
+    conn = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+    if wal:
+        conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS tasks (
+            task_id INTEGER PRIMARY KEY,
+            task_hash TEXT NOT NULL UNIQUE,
+            shard INTEGER NOT NULL,
+            chunks TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            worker TEXT,
+            claimed REAL,
+            attempts INTEGER NOT NULL DEFAULT 0
+        )""")
+    conn.execute("CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, shard)")
+    return conn
+
+def document_shard(source_type, n_shards):
+    # stable across runs and machines, unlike hash()
+    return int(hashlib.sha256(str(source_type).encode("utf-8")).hexdigest(), 16) % n_shards
+
+def iter_tasks(chunks, n_shards, task_size=TASK_SIZE):
+    """
+    Partition the chunk stream into tasks: the documents of a shard are grouped until task_size chunks.
+    The partition only depends on the input, so enqueueing the same input twice gives the same tasks.
+
+    @returns:
+        - a generator of (shard, chunks) tuples
+    """
+    buffers = {}
+    for doc_id, items in groupby(chunks, key=lambda item: item["source_type"]):
+        shard = document_shard(doc_id, n_shards)
+        buffer = buffers.setdefault(shard, [])
+        buffer.extend(items)
+        if len(buffer) >= task_size:
+            yield shard, buffers.pop(shard)
+    for shard, buffer in buffers.items():
+        yield shard, buffer
+
+def enqueue(conn, chunks, n_shards, task_size=TASK_SIZE):
+    """
+    Add the tasks of a chunk stream to the queue, tasks already queued are ignored
+
+    @returns:
+        - the number of new tasks
+    """
+    added = 0
+    conn.execute("BEGIN IMMEDIATE")
+    for shard, task_chunks in iter_tasks(chunks, n_shards, task_size):
+        payload = json.dumps(task_chunks, ensure_ascii=False)
+        task_hash = hashlib.sha256(payload.encode("utf-8")).hexdigest()
+        added += conn.execute("INSERT OR IGNORE INTO tasks (task_hash, shard, chunks) VALUES (?, ?, ?)",
+                              (task_hash, shard, payload)).rowcount
+    conn.execute("COMMIT")
+    return added
+
+def claim_task(conn, shard, worker, lease=LEASE_SECONDS):
+    """
+    Take the next task of a worker: a pending task of its own shard, otherwise a pending task of another shard,
+    otherwise a task whose worker did not renew its lease in time (crashed or stuck worker)
+
+    @returns:
+        - a (task_id, chunks) tuple, or None when there is nothing left to do
+    """
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute(
+            """SELECT task_id, chunks FROM tasks
+               WHERE status = 'pending' OR (status = 'running' AND claimed < ?)
+               ORDER BY status = 'running', shard != ?, task_id LIMIT 1""",
+            (now - lease, shard)).fetchone()
+        if row is not None:
+            conn.execute("UPDATE tasks SET status = 'running', worker = ?, claimed = ?, attempts = attempts + 1 WHERE task_id = ?",
+                         (worker, now, row[0]))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    if row is None:
+        return None
+    return row[0], json.loads(row[1])
+
+def renew_lease(conn, task_id, worker):
+    """
+    Restart the lease of a running task, called as the worker makes progress so that a long task
+    is not taken over while it is still being processed
+    """
+    conn.execute("UPDATE tasks SET claimed = ? WHERE task_id = ? AND worker = ? AND status = 'running'",
+                 (time.time(), task_id, worker))
+
+def complete_task(conn, task_id):
+    conn.execute("UPDATE tasks SET status = 'done' WHERE task_id = ?", (task_id,))
+
+def queue_status(conn):
+    """
+    Number of tasks by status
+    """
+    return dict(conn.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status"))
+
+
+# Workers
+
+def hf_token():
+    if not os.path.exists("authentification.json"):
+        return None
+    with open("authentification.json", "r") as f:
+        return json.load(f).get("hf_token")
+
+def load_model(model_name=MODEL_NAME, device="cpu"):
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    token = hf_token()
+    tokenizer = AutoTokenizer.from_pretrained(model_name, token=token)
+    model = AutoModelForCausalLM.from_pretrained(model_name, token=token).to(device)
+    return tokenizer, model
+
+def run_worker(shard, queue_path=QUEUE_DB, store_path=RESULT_DB, mode="two_pass", model_name=MODEL_NAME, device="cpu",
+               threads=None, lease=LEASE_SECONDS, shared_fs=False):
+    """
+    Process tasks until the queue is empty. Each worker holds its own copy of the model and writes
+    its results to the shared result store, a task is marked done once its results are committed.
+
+    @params:
+        - shard: the shard the worker starts with, other shards are stolen once it is empty
+        - queue_path, store_path: the task queue and the result store
+        - mode: "two_pass" (summary then structuration) or "single_pass" (constrained JSON decoding)
+        - model_name, device: the model to load
+        - threads: number of torch threads, all cores by default
+        - lease: seconds without progress after which a running task of another worker can be taken over
+        - shared_fs: the databases are on a network filesystem, write-ahead logging is disabled
+    """
+    import torch
+    from llm_utilities import extract_data_batched, extract_data_single_pass
+    from text_proccessor_utilities import pack_chunks
+
+    if threads:
+        torch.set_num_threads(threads)
+    extract = extract_data_single_pass if mode == "single_pass" else extract_data_batched
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    tokenizer, model = load_model(model_name, device)
+    queue = open_queue(queue_path, wal=not shared_fs)
+    store = open_store(store_path, wal=not shared_fs)
+
+    done = 0
+    while (task := claim_task(queue, shard, worker, lease)) is not None:
+        task_id, chunks = task
+        # the lease is renewed after each batch, a task only expires when its worker stops making progress
+        extract(pack_chunks(chunks, tokenizer), None, device, tokenizer, model, store=store,
+                on_batch=lambda: renew_lease(queue, task_id, worker))
+        complete_task(queue, task_id)
+        done += 1
+    print(f"Worker {worker} (shard {shard}): {done} tasks processed")
+
+def queue_chunk_keys(conn, tokenizer):
+    """
+    Keys of the windows the workers extract from the tasks of the queue, packed as in run_worker
+    """
+    from text_proccessor_utilities import pack_chunks
+
+    keys = []
+    for (chunks,) in conn.execute("SELECT chunks FROM tasks ORDER BY task_id"):
+        keys.extend(chunk_key(window) for window in pack_chunks(json.loads(chunks), tokenizer))
+    return keys
+
+def merge(output_file="output_dataset.csv", store_path=RESULT_DB, mode="two_pass", model_name=MODEL_NAME, queue_path=QUEUE_DB):
+    """
+    Write the deduplicated occurrence table of all the workers, limited to the chunks of the queue
+    """
+    from transformers import AutoTokenizer
+    from llm_utilities import run_signature, export_results
+
+    keys = queue_chunk_keys(open_queue(queue_path), AutoTokenizer.from_pretrained(model_name, token=hf_token()))
+    export_results(open_store(store_path), run_signature(MODES[mode], model_name), output_file, keys)
+
+def run_local(input_file="input.jsonl", output_file="output_dataset.csv", workers=2, queue_path=QUEUE_DB, store_path=RESULT_DB,
+              mode="two_pass", model_name=MODEL_NAME, task_size=TASK_SIZE, lease=LEASE_SECONDS):
+    """
+    Enqueue the input, run one worker process per shard on this machine, the cores being split between them,
+    and merge their results
+    """
+    print(f"{enqueue(open_queue(queue_path), iter_records(input_file), workers, task_size)} new tasks")
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    context = mp.get_context("spawn")
+    processes = [context.Process(target=run_worker, args=(shard, queue_path, store_path, mode, model_name, "cpu", threads, lease))
+                 for shard in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    print(queue_status(open_queue(queue_path)))
+    merge(output_file, store_path, mode, model_name, queue_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sharded extraction over a SQLite task queue")
+    parser.add_argument("command", choices=["local", "enqueue", "worker", "merge", "status"])
+    parser.add_argument("--input", default="input.jsonl")
+    parser.add_argument("--output", default="output_dataset.csv")
+    parser.add_argument("--workers", type=int, default=2, help="local worker processes, or number of shards")
+    parser.add_argument("--shard", type=int, default=0, help="shard of a worker started by hand")
+    parser.add_argument("--queue", default=QUEUE_DB)
+    parser.add_argument("--store", default=RESULT_DB)
+    parser.add_argument("--mode", choices=list(MODES), default="two_pass")
+    parser.add_argument("--model", default=MODEL_NAME)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--task-size", type=int, default=TASK_SIZE)
+    parser.add_argument("--lease", type=float, default=LEASE_SECONDS)
+    parser.add_argument("--shared-fs", action="store_true", help="the queue and the store are on a network filesystem")
+    args = parser.parse_args()
+
+    if args.command == "local":
+        run_local(args.input, args.output, args.workers, args.queue, args.store, args.mode, args.model, args.task_size, args.lease)
+    elif args.command == "enqueue":
+        print(f"{enqueue(open_queue(args.queue, wal=not args.shared_fs), iter_records(args.input), args.workers, args.task_size)} new tasks")
+    elif args.command == "worker":
+        run_worker(args.shard, args.queue, args.store, args.mode, args.model, args.device, args.threads, args.lease, args.shared_fs)
+    elif args.command == "merge":
+        merge(args.output, args.store, args.mode, args.model, args.queue)
+    else:
+        print(queue_status(open_queue(args.queue, wal=not args.shared_fs)))
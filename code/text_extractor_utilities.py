@@ -1,62 +1,122 @@
 # general import
 import os
 import pandas as pd
-from pdf2image import convert_from_path
+from pdf2image import convert_from_path, pdfinfo_from_path
 from pytesseract import image_to_string
 import PyPDF2
 import re
+import json
+import hashlib
 import logging
 from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import camelot.io as camelot
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-def extract_text_with_pypdf2(pdf_path):
+# OCR settings
+OCR_DPI = 200           # rasterisation resolution
+OCR_WORKERS = 4         # Tesseract processes run in parallel for a PDF processed alone
+OCR_PAGE_RANGE = 4      # pages rasterised at once, bounds the number of images in memory
+MIN_PAGE_CHARS = 10     # pages with fewer non-whitespace characters in their text layer are OCRed
+
+# Table pre-scan settings
+CAMELOT_CACHE_FOLDER = "camelot_cache"
+TABLE_CAPTION_PATTERN = re.compile(r'\btable\s+(?:\d+|[IVX]+)\b', re.IGNORECASE)
+NUMBER_PATTERN = re.compile(r'\d+(?:[.,]\d+)?')
+SPECIES_PATTERN = re.compile(r'aegypti|albopictus', re.IGNORECASE)
+MIN_NUMERIC_LINES = 5   # lines with at least 3 numbers that make a page look like a grid
+
+def read_pdf_pages(pdf_path):
     """
-    Extract text using PyPDF2 library
+    Extract the text of every page, opening the PDF only once
     
     @params:
         - pdf_path: path to the PDF file
         
     @returns:
-        - extracted text as string
+        - list of page texts, None if the PDF could not be read
     """
-    text = ""
     try:
         with open(pdf_path, 'rb') as file:
             pdf_reader = PyPDF2.PdfReader(file)
-            num_pages = len(pdf_reader.pages)
-            
-            for page_num in range(num_pages):
-                page = pdf_reader.pages[page_num]
-                text += page.extract_text() + "\n\n"
-        
-        # If text extraction returned substantial content, return it
-        if len(re.sub(r'\s+', '', text)) > 100:  
-            return text
+            return [page.extract_text() or "" for page in pdf_reader.pages]
     except Exception as e:
         logger.warning(f"PyPDF2 extraction failed: {e}")
-    
-    return None
+        return None
 
-def convert_pdf_to_img(pdf_file):
+def convert_pdf_to_img(pdf_file, dpi=OCR_DPI, first_page=None, last_page=None):
     """
     Convert a PDF into Images
     
     @params:
         - pdf_file: the file to be converted
+        - dpi: resolution of the images
+        - first_page, last_page: optional page range to convert (1-based, inclusive)
     
     @returns:
-        - an iterable containing image format of all the pages of the PDF
+        - an iterable containing image format of the pages of the PDF
     """
     try:
-        return convert_from_path(pdf_file)
+        return convert_from_path(pdf_file, dpi=dpi, first_page=first_page, last_page=last_page)
     except Exception as e:
         logger.error(f"Error converting PDF to images: {e}")
         return []
 
+def count_pdf_pages(pdf_path):
+    """
+    Count the pages of a PDF that PyPDF2 could not read, using poppler
+    """
+    try:
+        return pdfinfo_from_path(pdf_path)["Pages"]
+    except Exception as e:
+        logger.error(f"Could not count the pages of {pdf_path}: {e}")
+        return 0
+
+def page_ranges(page_numbers, max_length=OCR_PAGE_RANGE):
+    """
+    Group sorted page numbers into ranges of consecutive pages
+    
+    @returns:
+        - a list of (first_page, last_page) tuples
+    """
+    ranges = []
+    for page_num in sorted(page_numbers):
+        if ranges and page_num == ranges[-1][1] + 1 and page_num - ranges[-1][0] < max_length:
+            ranges[-1] = (ranges[-1][0], page_num)
+        else:
+            ranges.append((page_num, page_num))
+    return ranges
+
+def ocr_pages(pdf_path, page_numbers, dpi=OCR_DPI, workers=OCR_WORKERS, range_length=OCR_PAGE_RANGE):
+    """
+    OCR selected pages of a PDF.
+    Pages are rasterised lazily, one range at a time, and the images of a range are OCRed in parallel
+    before the next range is rasterised, so at most range_length images are held in memory.
+    
+    @params:
+        - pdf_path: path to the PDF file
+        - page_numbers: the pages to OCR (1-based)
+        - dpi: rasterisation resolution
+        - workers: number of parallel Tesseract processes
+        - range_length: maximum number of pages rasterised at once
+    
+    @returns:
+        - a dictionary with page numbers as keys and OCR text as values
+    """
+    ocr_texts = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for first_page, last_page in page_ranges(page_numbers, range_length):
+            images = convert_pdf_to_img(pdf_path, dpi=dpi, first_page=first_page, last_page=last_page)
+            # Tesseract runs as a subprocess, threads are enough to use several cores
+            texts = executor.map(convert_image_to_text, images)
+            for page_num, text in zip(range(first_page, last_page + 1), texts):
+                ocr_texts[page_num] = text
+            del images
+    return ocr_texts
+
 def convert_image_to_text(file):
     """
     Extract text from image using OCR
@@ -74,163 +134,236 @@ def convert_image_to_text(file):
         logger.error(f"Error in OCR: {e}")
         return ""
 
-def extract_tables_with_camelot(pdf_path):
+def find_table_pages(page_texts):
     """
-    Extract tables from PDF using Camelot
+    Cheap pre-scan selecting the pages likely to contain a table from their extracted text:
+    a "Table N" caption, a dense numeric grid, or species names next to a few numeric rows
     
     @params:
-        - pdf_path: path to the PDF file
+        - page_texts: list of page texts
         
     @returns:
-        - a dictionary with page numbers as keys and list of tables as values
+        - sorted list of candidate page numbers (1-based)
     """
-    tables_by_page = {}
+    candidates = []
+    for page_num, page_text in enumerate(page_texts, 1):
+        numeric_lines = sum(1 for line in page_text.split("\n") if len(NUMBER_PATTERN.findall(line)) >= 3)
+        if (TABLE_CAPTION_PATTERN.search(page_text)
+                or numeric_lines >= MIN_NUMERIC_LINES
+                or (numeric_lines >= 2 and SPECIES_PATTERN.search(page_text))):
+            candidates.append(page_num)
+    return candidates
+
+def file_hash(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+def camelot_cache_path(cache_folder, pdf_hash, page_num, flavor):
+    return os.path.join(cache_folder, pdf_hash, f"{page_num}_{flavor}.json")
+
+def load_cached_tables(cache_folder, pdf_hash, page_num, flavor):
+    """
+    Return the cached tables of a (file hash, page, flavor), None if not cached
+    """
+    path = camelot_cache_path(cache_folder, pdf_hash, page_num, flavor)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def store_cached_tables(cache_folder, pdf_hash, page_num, flavor, tables):
+    path = camelot_cache_path(cache_folder, pdf_hash, page_num, flavor)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(tables, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def run_camelot(pdf_path, page_numbers, flavor):
+    """
+    Run Camelot once over a set of pages
     
-    try:
-        # Try lattice mode first (for tables with borders)
-        tables = camelot.read_pdf(pdf_path, pages='all', flavor='lattice')
-        
-        # If no tables found with lattice, try stream mode (for tables without clear borders)
-        if len(tables) == 0:
-            tables = camelot.read_pdf(pdf_path, pages='all', flavor='stream')
+    @params:
+        - pdf_path: path to the PDF file
+        - page_numbers: the pages to parse
+        - flavor: 'lattice' (tables with borders) or 'stream' (tables without clear borders)
         
-        # Process each table
-        for i, table in enumerate(tables):
-            if table.df.empty:
-                continue
-                
-            page_num = table.parsing_report['page']
-            
-            # Format table text
-            table_text = f"\n\n{'-'*20} TABLE {i+1} {'-'*20}\n"
-            table_text += table.df.to_string(index=False) + "\n"
-            table_text += f"{'-'*50}\n"
-            
-            # Add to dictionary, creating list if page not already present
-            if page_num not in tables_by_page:
-                tables_by_page[page_num] = []
-            tables_by_page[page_num].append(table_text)
-            
+    @returns:
+        - a dictionary with every requested page number as key and the list of its tables as text,
+          None for the pages on which Camelot failed
+    """
+    tables_by_page = {page_num: [] for page_num in page_numbers}
+    try:
+        tables = camelot.read_pdf(pdf_path, pages=",".join(map(str, page_numbers)), flavor=flavor)
+        for table in tables:
+            if not table.df.empty:
+                tables_by_page[int(table.parsing_report['page'])].append(table.df.to_string(index=False))
     except Exception as e:
-        logger.warning(f"Camelot table extraction failed: {str(e)}")
-        try:
-            # Get total page count
+        logger.warning(f"Camelot {flavor} extraction failed: {str(e)}")
+        if len(page_numbers) > 1:
+            # Process pages individually so that one bad page does not lose the others
+            for page_num in page_numbers:
+                tables_by_page.update(run_camelot(pdf_path, [page_num], flavor))
+        else:
+            tables_by_page[page_numbers[0]] = None
+    return tables_by_page
+
+def extract_tables_with_camelot(pdf_path, total_pages=None, page_texts=None, cache_folder=CAMELOT_CACHE_FOLDER):
+    """
+    Extract tables from PDF using Camelot.
+    Camelot only runs on the candidate pages of the pre-scan, in lattice mode first and in stream mode
+    for the pages where lattice found nothing. Results are cached per (file hash, page, flavor).
+    
+    @params:
+        - pdf_path: path to the PDF file
+        - total_pages: number of pages of the PDF, read from the file if None
+        - page_texts: extracted page texts used by the pre-scan, every page is a candidate if None
+        - cache_folder: folder of the Camelot cache
+        
+    @returns:
+        - a dictionary with page numbers as keys and list of tables as values
+    """
+    if page_texts is not None:
+        candidate_pages = find_table_pages(page_texts)
+    else:
+        if total_pages is None:
             with open(pdf_path, 'rb') as file:
-                pdf_reader = PyPDF2.PdfReader(file)
-                total_pages = len(pdf_reader.pages)
-                
-            # Process pages individually
-            for page_num in range(1, total_pages + 1):
-                try:
-                    page_tables = camelot.read_pdf(pdf_path, pages=str(page_num), flavor='lattice')
-                    if len(page_tables) == 0:
-                        page_tables = camelot.read_pdf(pdf_path, pages=str(page_num), flavor='stream')
-                    
-                    for i, table in enumerate(page_tables):
-                        if table.df.empty:
-                            continue
-                            
-                        # Format table text
-                        table_idx = len(tables_by_page.get(page_num, [])) + 1
-                        table_text = f"\n\n{'-'*20} TABLE ON PAGE {page_num} ({table_idx}) {'-'*20}\n"
-                        table_text += table.df.to_string(index=False) + "\n"
-                        table_text += f"{'-'*50}\n"
-                        
-                        # Add to dictionary
-                        if page_num not in tables_by_page:
-                            tables_by_page[page_num] = []
-                        tables_by_page[page_num].append(table_text)
-                except Exception as page_e:
-                    continue
-        except Exception as fallback_e:
-            logger.warning(f"Fallback table extraction failed: {str(fallback_e)}")
+                total_pages = len(PyPDF2.PdfReader(file).pages)
+        candidate_pages = list(range(1, total_pages + 1))
+    if not candidate_pages:
+        return {}
+    
+    pdf_hash = file_hash(pdf_path)
+    raw_tables = {}
+    remaining_pages = candidate_pages
+    for flavor in ('lattice', 'stream'):
+        found = {}
+        missing = []
+        for page_num in remaining_pages:
+            cached = load_cached_tables(cache_folder, pdf_hash, page_num, flavor)
+            if cached is None:
+                missing.append(page_num)
+            else:
+                found[page_num] = cached
+        if missing:
+            for page_num, tables in run_camelot(pdf_path, missing, flavor).items():
+                # a failure (missing Ghostscript, bad page, ...) is not cached, the page is retried on the next run
+                if tables is not None:
+                    store_cached_tables(cache_folder, pdf_hash, page_num, flavor, tables)
+                found[page_num] = tables
+        raw_tables.update((page_num, tables) for page_num, tables in found.items() if tables)
+        # stream mode only for the pages without bordered tables
+        remaining_pages = [page_num for page_num in remaining_pages if not found.get(page_num)]
+        if not remaining_pages:
+            break
+    
+    # Format table text
+    tables_by_page = {}
+    counter = 0
+    for page_num in sorted(raw_tables):
+        for table in raw_tables[page_num]:
+            counter += 1
+            table_text = f"\n\n{'-'*20} TABLE {counter} {'-'*20}\n"
+            table_text += table + "\n"
+            table_text += f"{'-'*50}\n"
+            tables_by_page.setdefault(page_num, []).append(table_text)
     
     return tables_by_page
 
-def get_text_from_any_pdf(pdf_path):
+def get_text_from_any_pdf(pdf_path, ocr_workers=OCR_WORKERS):
     """
     Extract both regular text and tables from a PDF, 
     
     @params:
         - pdf_path: path to the PDF file
+        - ocr_workers: number of parallel Tesseract processes
         
     @returns:
         - combined text from the PDF with tables in context
     """
-    tables_by_page = extract_tables_with_camelot(pdf_path)
-    
-    total_pages = 0
-    try:
-        with open(pdf_path, 'rb') as file:
-            pdf_reader = PyPDF2.PdfReader(file)
-            total_pages = len(pdf_reader.pages)
-    except Exception as e:
-        total_pages = 1000
+    # The PDF is parsed once, the page texts are reused for every step
+    page_texts = read_pdf_pages(pdf_path)
+    if page_texts is None:
+        page_texts = [""] * count_pdf_pages(pdf_path)
     
-    # Try to extract text using PyPDF2
-    pypdf_text = extract_text_with_pypdf2(pdf_path)
-    
-    if pypdf_text:
+    # Fall back to OCR only for the pages without a text layer (scanned pages)
+    empty_pages = [page_num for page_num, page_text in enumerate(page_texts, 1)
+                   if len(re.sub(r'\s+', '', page_text)) < MIN_PAGE_CHARS]
+    if empty_pages:
+        logger.info(f"Using OCR for {len(empty_pages)}/{len(page_texts)} pages")
+        for page_num, page_text in ocr_pages(pdf_path, empty_pages, workers=ocr_workers).items():
+            page_texts[page_num - 1] = page_text
+    else:
         logger.info(f"Successfully extracted text with PyPDF2")   
-        combined_text = ""   
-        try:
-            with open(pdf_path, 'rb') as file:
-                pdf_reader = PyPDF2.PdfReader(file)
-                
-                for page_num in range(len(pdf_reader.pages)):
-                    actual_page_num = page_num + 1  
-                    page_text = pdf_reader.pages[page_num].extract_text()
-                    
-                    combined_text += f"\n\nPAGE {actual_page_num}:\n{page_text}\n"
-                    
-                    # Insert tables for this page if present
-                    if actual_page_num in tables_by_page:
-                        for table in tables_by_page[actual_page_num]:
-                            combined_text += table
-        except Exception as e:
-            logger.warning(f"Page-by-page extraction failed: {e}")
-            
-            # Fallback: use the whole text with tables inserted at the end
-            combined_text = pypdf_text
-            
-            for page_num, tables in sorted(tables_by_page.items()):
-                for table in tables:
-                    combined_text += f"\n\nFrom Page {page_num}:\n{table}"
     
-    else:
-        # Fall back to OCR for scanned PDFs
-        logger.info(f"Using OCR for text extraction")
-        images = convert_pdf_to_img(pdf_path)
-        combined_text = ""
+    tables_by_page = extract_tables_with_camelot(pdf_path, len(page_texts), page_texts)
+    
+    combined_parts = []
+    for page_num, page_text in enumerate(page_texts, 1):
+        combined_parts.append(f"\n\nPAGE {page_num}:\n{page_text}\n")
         
-        # Process each page
-        for pg, img in enumerate(images):
-            page_num = pg + 1  
-            page_text = convert_image_to_text(img)
-            
-            # Add page header
-            combined_text += f"\n\nPAGE {page_num}:\n{page_text}"
-            
-            # Insert tables for this page if present
-            if page_num in tables_by_page:
-                for table in tables_by_page[page_num]:
-                    combined_text += table
+        # Insert tables for this page if present
+        combined_parts.extend(tables_by_page.get(page_num, []))
     
-    return combined_text
+    return "".join(combined_parts)
 
-def process_pdfs(input_folder, output_folder):
+def process_pdf(pdf_path, output_folder, ocr_workers=OCR_WORKERS):
+    """
+    Extract the text of a single PDF and save it as a text file
+    
+    @params:
+        - pdf_path: path to the PDF file
+        - output_folder: folder to save the extracted text file
+        - ocr_workers: number of parallel Tesseract processes
+    
+    @returns:
+        - the name of the text file
+    """
+    text = get_text_from_any_pdf(pdf_path, ocr_workers)
+    
+    base_name = os.path.splitext(os.path.basename(pdf_path))[0]
+    output_file = base_name + ".txt"
+    output_path = os.path.join(output_folder, output_file)
+    
+    with open(output_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    return output_file
+
+def process_pdfs(input_folder, output_folder, workers=1):
     """
     Process all PDFs in a folder
     
     @params:
         - input_folder: folder containing PDF files
         - output_folder: folder to save extracted text files
+        - workers: number of cores used. The PDFs are spread over at most this many processes and the cores
+          left are given to the OCR of each process, so at most workers Tesseract processes run at once.
+          PDFs are processed one at a time with OCR_WORKERS Tesseract processes if 1
     """
     os.makedirs(output_folder, exist_ok=True)
     
     pdf_files = [f for f in os.listdir(input_folder) if f.lower().endswith('.pdf')]
     total_files = len(pdf_files)
     
+    if workers > 1:
+        # text extraction, Camelot and OCR are CPU-bound, spread the PDFs over processes
+        processes = max(1, min(workers, total_files))
+        ocr_workers = max(1, workers // processes)
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = {executor.submit(process_pdf, os.path.join(input_folder, filename), output_folder, ocr_workers): filename
+                       for filename in pdf_files}
+            for counter, future in enumerate(tqdm(as_completed(futures), total=total_files, desc="Processing PDFs"), 1):
+                filename = futures[future]
+                try:
+                    output_file = future.result()
+                    logger.info(f"Completed {filename} -> {output_file} ({counter}/{total_files})")
+                except Exception as e:
+                    logger.error(f"Error processing {filename}: {e}")
+        return
+    
     # Loop through each PDF file in the input folder
     for counter, filename in enumerate(tqdm(pdf_files, desc="Processing PDFs"), 1):
         pdf_path = os.path.join(input_folder, filename)
@@ -238,14 +371,7 @@ def process_pdfs(input_folder, output_folder):
         try:
             logger.info(f"Processing {counter}/{total_files}: {filename}")
             
-            text = get_text_from_any_pdf(pdf_path)
-            
-            base_name = os.path.splitext(filename)[0]
-            output_file = base_name + ".txt"
-            output_path = os.path.join(output_folder, output_file)
-            
-            with open(output_path, "w", encoding="utf-8") as f:
-                f.write(text)
+            output_file = process_pdf(pdf_path, output_folder)
                 
             logger.info(f"Completed {filename} -> {output_file} ({counter}/{total_files})")
             
@@ -3,106 +3,327 @@ import spacy
 import os
 import re
 import json
-from collections import defaultdict
+import pycountry
+from bisect import bisect_right
+from collections import deque
+from itertools import groupby
 from tqdm import tqdm
 
+NER_MODEL = "en_core_web_sm"
+NER_BATCH_SIZE = 64
+NER_PROCESSES = 1
+NER_MAX_PENDING = 1024  # chunks read ahead of the output of filter_date_loc at most
+WINDOW_TOKENS = 2048    # maximum tokens of text in a packed extraction window
+WINDOW_OVERLAP = 128    # tokens repeated at the start of the next window of a document
+DATE_LOC_LABELS = {"DATE", "GPE", "LOC"}
+
+def load_ner_pipeline(model=NER_MODEL):
+    """
+    Load a SpaCy pipeline reduced to its entity recognizer.
+    Parser, tagger, lemmatizer, ... are removed, the shared tok2vec is kept only if the NER listens to it.
+    """
+    nlp = spacy.load(model)
+    needed = {"ner"} | {name for name, pipe in nlp.pipeline if "ner" in getattr(pipe, "listening_components", [])}
+    for name in list(nlp.pipe_names):
+        if name not in needed:
+            nlp.remove_pipe(name)
+    return nlp
+
 # Load SpaCy's NER model
-nlp = spacy.load("en_core_web_sm")
+nlp = load_ner_pipeline()
 
-def read_text_files_from_folder(input_folder):
-    texts = {}
-    for filename in os.listdir(input_folder):
+# Cheap tiers run before the NER model
+YEAR_PATTERN = re.compile(r'(?<!\d)(?:1[89]\d{2}|20\d{2})(?!\d)')
+CAPITAL_OR_DIGIT_PATTERN = re.compile(r'[A-Z0-9]')
+WORD_PATTERN = re.compile(r"\w+(?:['-]\w+)*")
+# lowercase words spaCy tags as DATE ("the rainy season", "every year"), a chunk without capital or digit
+# is only rejected without the NER when it has none of them
+DATE_WORD_PATTERN = re.compile(
+    r"\b(?:january|february|march|april|may|june|july|august|september|october|november|december"
+    r"|seasons?|seasonal|summers?|winters?|springs?|autumns?|fall|years?|yearly|annual(?:ly)?|months?|monthly"
+    r"|weeks?|weekly|days?|daily|decades?|centur(?:y|ies)|today|yesterday)\b")
+# generic geographic words that are also region names
+GAZETTEER_STOPWORDS = {"Bay", "Bar", "Central", "Centre", "Center", "Coast", "Delta", "East", "West", "North", "South",
+                       "Eastern", "Western", "Northern", "Southern", "Upper", "Lower", "Capital", "Islands", "Lakes",
+                       "Valley", "River", "Federal", "Plateau", "Littoral", "Savanes", "Chin"}
+# single-word region names shorter than this are left to the NER, many of them are also common words
+# or first names and surnames ("Male", "Para", "Norte", "Kent", "Paul", "Nelson")
+MIN_REGION_WORD_LENGTH = 7
+
+def load_gazetteer(path=None):
+    """
+    Load the names of countries and first-level administrative regions.
+    Country names and multi-word region names always count as a location. Single-word region names
+    are kept from MIN_REGION_WORD_LENGTH characters on and only count inside a sentence: at the start
+    of a sentence, a capitalized word says nothing about it being a name.
+
+    @params:
+        - path: optional text file with one place name per line (all counted as countries), the ISO 3166 names
+          of pycountry are used if None
+
+    @returns:
+        - a dictionary place name -> whether it is a single-word region name, each name normalized to its words
+          separated by single spaces
+    """
+    if path is not None:
+        with open(path, "r", encoding="utf-8") as f:
+            countries = [line.strip() for line in f if line.strip()]
+        regions = []
+    else:
+        countries = [country.name for country in pycountry.countries]
+        countries += [getattr(country, attr) for country in pycountry.countries
+                      for attr in ("official_name", "common_name") if hasattr(country, attr)]
+        regions = [subdivision.name for subdivision in pycountry.subdivisions]
+    gazetteer = {}
+    for names, is_region in ((regions, True), (countries, False)):
+        for name in names:
+            name = " ".join(WORD_PATTERN.findall(name.replace("’", "'")))
+            if len(name) < 4 or not name[0].isupper() or name in GAZETTEER_STOPWORDS:
+                continue
+            region_word = is_region and " " not in name
+            if region_word and len(name) < MIN_REGION_WORD_LENGTH:
+                continue
+            # a name that is also a country is a country
+            gazetteer[name] = region_word
+    return gazetteer
+
+GAZETTEER = load_gazetteer()
+GAZETTEER_MAX_WORDS = max(len(name.split()) for name in GAZETTEER)
+
+def is_sentence_start(text, start):
+    # only the few characters before the word are looked at, a long blank run counts as a sentence start
+    before = text[max(0, start - 32):start].rstrip(" \t\"'(")
+    return not before or before[-1] in ".!?:;\n"
+
+def contains_gazetteer_name(text, gazetteer=GAZETTEER, max_words=GAZETTEER_MAX_WORDS):
+    """
+    Look up every word n-gram starting with a capitalized word in the gazetteer, linear in the length of the text
+    """
+    text = text.replace("’", "'")
+    matches = list(WORD_PATTERN.finditer(text))
+    words = [match.group() for match in matches]
+    for i, word in enumerate(words):
+        if not word[0].isupper():
+            continue
+        for n in range(1, min(max_words, len(words) - i) + 1):
+            region_word = gazetteer.get(" ".join(words[i:i + n]))
+            if region_word is None:
+                continue
+            if not region_word or not is_sentence_start(text, matches[i].start()):
+                return True
+    return False
+
+def prefilter_date_loc(text):
+    """
+    Classify a chunk without the NER model when possible
+
+    @returns:
+        - a (decision, tier) tuple, decision is None when the chunk must go to the NER model
+    """
+    if YEAR_PATTERN.search(text):
+        return True, "year"
+    if not CAPITAL_OR_DIGIT_PATTERN.search(text):
+        # a lowercase date ("during the rainy season") is still found by the NER
+        if DATE_WORD_PATTERN.search(text):
+            return None, "ner"
+        return False, "no_capital_or_digit"
+    if contains_gazetteer_name(text):
+        return True, "gazetteer"
+    return None, "ner"
+
+def iter_text_files_from_folder(input_folder):
+    for filename in sorted(os.listdir(input_folder)):
         if filename.endswith(".txt"):
             filepath = os.path.join(input_folder, filename)
             with open(filepath, "r", encoding="utf-8") as f:
-                texts[filename] = f.read()
-    return texts
+                yield filename, f.read()
+
+def read_text_files_from_folder(input_folder):
+    return dict(iter_text_files_from_folder(input_folder))
+
+HEADER_PATTERN = re.compile(
+    r'^(?:\d+[\.\s]*)?'                     # Optional numbers
+    r'([A-Z][A-Z0-9\s\-]*[A-Z])$'           # UPPERCASE headers
+    r'|^([A-Z][a-z]+(?:\s[A-Z][a-z]+)*)$'   # Title Case
+    r'|^(\b[A-Z][a-z]+\b)$'                 # Single capitalized word
+)
+HEADER_NUMBER_PATTERN = re.compile(r'^\d+[\.\s]*')
+PARAGRAPH_BREAK_PATTERN = re.compile(r"\n\s*\n")
 
 def detect_headers(text):
-    header_pattern = re.compile(
-        r'^(?:\d+[\.\s]*)?'                     # Optional numbers
-        r'([A-Z][A-Z0-9\s\-]*[A-Z])$'           # UPPERCASE headers
-        r'|^([A-Z][a-z]+(?:\s[A-Z][a-z]+)*)$'   # Title Case
-        r'|^(\b[A-Z][a-z]+\b)$'                 # Single capitalized word
-    )
     headers = []
     for line in text.split("\n"):
-        match = header_pattern.match(line.strip())
+        match = HEADER_PATTERN.match(line.strip())
         if match:
             header = next(group for group in match.groups() if group)
             headers.append(header)
     return headers
 
 def normalize_header(header):
-    header = re.sub(r'^\d+[\.\s]*', '', header)
+    header = HEADER_NUMBER_PATTERN.sub('', header)
     return header.strip().upper()
 
 def paragraph_chunking(text):
-    paragraphs = re.split(r"\n\s*\n", text)
+    paragraphs = PARAGRAPH_BREAK_PATTERN.split(text)
     return [p.strip() for p in paragraphs if p.strip()]
 
 def chunk_text(text):
-    headers = detect_headers(text)
-    headers = [normalize_header(h) for h in headers]
+    # set lookup, each line is tested in constant time
+    headers = {normalize_header(h) for h in detect_headers(text)}
 
     sections = []
-    current_section = ""
+    current_lines = []
     for line in text.split("\n"):
-        normalized_line = normalize_header(line)
-        if normalized_line in headers:
-            if current_section:
-                sections.append(current_section.strip())
-            current_section = line + "\n"
+        if current_lines and normalize_header(line) in headers:
+            sections.append("\n".join(current_lines).strip())
+            current_lines = [line]
         else:
-            current_section += line + "\n"
+            current_lines.append(line)
 
-    if current_section:
-        sections.append(current_section.strip())
+    if current_lines:
+        sections.append("\n".join(current_lines).strip())
 
     if len(sections) <= 1:
         return paragraph_chunking(text)
     return sections
 
+def has_date_or_location(doc):
+    # stops at the first date or location entity
+    return any(ent.label_ in DATE_LOC_LABELS for ent in doc.ents)
+
 def contains_date_and_location(text):
     # Process the text with SpaCy NER model
-    doc = nlp(text)
-
-    # Check if there are date or location entities
-    dates = [ent for ent in doc.ents if ent.label_ == "DATE"]
-    locations = [ent for ent in doc.ents if ent.label_ == "GPE" or ent.label_ == "LOC"]
-
-    return len(dates) > 0 or len(locations) > 0
+    return has_date_or_location(nlp(text))
 
 
 def process_text_files(input_folder):
-    texts = read_text_files_from_folder(input_folder)
-    structured_data = []
-
-    for filename, content in texts.items():
+    # files are read and chunked one at a time
+    for filename, content in iter_text_files_from_folder(input_folder):
         doc_id = os.path.splitext(filename)[0]
-        segments = chunk_text(content)
-        for segment in segments:
-            structured_data.append({"source_type": doc_id, "text": segment})
+        for segment in chunk_text(content):
+            yield {"source_type": doc_id, "text": segment}
 
-    return structured_data
+# species names, tolerating separators between letters ("ae-gypti", "albo pictus")
+SPECIES_KEYWORDS = ["albopictus", "aegypti"]
+SPECIES_FUZZY_PATTERN = re.compile('|'.join([''.join([f'{char}[\\W_]*' for char in word]) for word in SPECIES_KEYWORDS]), re.IGNORECASE)
 
 def filter_species(data):
-    keywords = ["albopictus", "aegypti"]
-    regex_pattern = '|'.join([''.join([f'{char}[\\W_]*' for char in word]) for word in keywords])
-    filtered_data = [item for item in data if re.search(regex_pattern, item.get("text", "").lower())]
-    return filtered_data
+    for item in data:
+        if SPECIES_FUZZY_PATTERN.search(item.get("text", "")):
+            yield item
+
+def filter_date_loc(chunks, batch_size=NER_BATCH_SIZE, n_process=NER_PROCESSES, stats=None, max_pending=NER_MAX_PENDING):
+    """
+    Keep the chunks that mention a date or a location.
+    A year regex and a gazetteer accept (or reject) most chunks, only the ambiguous ones are
+    sent through nlp.pipe in batches, optionally over several processes.
+    Chunks are yielded in their input order, as soon as no earlier chunk is waiting for the NER.
+
+    @params:
+        - chunks: iterable of chunks
+        - batch_size: NER batch size
+        - n_process: number of NER processes, each NER run is given batch_size chunks per process
+        - stats: optional dictionary filled with the number of chunks decided by each tier
+        - max_pending: maximum number of chunks read ahead of the output, the waiting chunks are sent to the NER
+          before the batch is full when it is reached
+    """
+    if stats is None:
+        stats = {}
+    pending = deque()   # [chunk, decision] in input order
+    waiting = []        # pending entries waiting for the NER
+    ner_batch = batch_size * n_process
+
+    def run_ner():
+        docs = nlp.pipe((entry[0]['text'] for entry in waiting), batch_size=batch_size, n_process=n_process)
+        for entry, doc in zip(waiting, docs):
+            entry[1] = has_date_or_location(doc)
+        waiting.clear()
+
+    def flush():
+        while pending and pending[0][1] is not None:
+            chunk, decision = pending.popleft()
+            if decision:
+                yield chunk
 
-def filter_date_loc(chunks):
-    filtered_chunks = []
     for chunk in tqdm(chunks):
-        if contains_date_and_location(chunk['text']):
-            filtered_chunks.append(chunk)
-    return filtered_chunks
+        decision, tier = prefilter_date_loc(chunk['text'])
+        stats[tier] = stats.get(tier, 0) + 1
+        entry = [chunk, decision]
+        pending.append(entry)
+        if decision is None:
+            waiting.append(entry)
+        if waiting and (len(waiting) >= ner_batch or len(pending) >= max_pending):
+            run_ner()
+        yield from flush()
+    if waiting:
+        run_ner()
+    yield from flush()
+
+    total = sum(stats.values())
+    print(f"Date/location filter: {total} chunks, " + ", ".join(f"{tier}: {count}" for tier, count in stats.items())
+          + f" -> NER avoided for {total - stats.get('ner', 0)}/{total}")
 
 def combine_chunks(chunks):
-    combined = defaultdict(str)   
-    for item in chunks:
-        combined[item['source_type']] += item['text']
-    result = [{'source_type': doc_id, 'text': text} for doc_id, text in combined.items()]
-    return result
+    # chunks of a document are contiguous in the stream, only one document is held at a time
+    for doc_id, items in groupby(chunks, key=lambda item: item['source_type']):
+        yield {'source_type': doc_id, 'text': ''.join(item['text'] for item in items)}
+
+def pack_document(source_type, texts, tokenizer, max_tokens=WINDOW_TOKENS, overlap=WINDOW_OVERLAP):
+    """
+    Pack the chunks of one document into windows of at most max_tokens tokens.
+    Consecutive chunks are merged while they fit, a window ends on a chunk boundary when there is one
+    and a chunk longer than the budget is cut by tokens.
+
+    @params:
+        - source_type: the document the chunks come from
+        - texts: the chunk texts of the document, in order
+        - tokenizer: the tokenizer of the extraction model
+        - max_tokens: token budget of a window
+        - overlap: number of tokens of a window repeated at the start of the next one
+
+    @returns:
+        - a generator of windows with source_type, window (index in the document) and text
+    """
+    text = "\n\n".join(texts)
+    offsets = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)["offset_mapping"]
+    if not offsets:
+        return
+    token_starts = [start for start, _ in offsets]
+
+    # index of the first token of each chunk
+    boundaries = []
+    position = 0
+    for chunk in texts:
+        boundaries.append(bisect_right(token_starts, position - 1))
+        position += len(chunk) + 2
+
+    start, window = 0, 0
+    while True:
+        end = min(start + max_tokens, len(offsets))
+        if end < len(offsets):
+            # last chunk boundary that keeps the window longer than the overlap
+            idx = bisect_right(boundaries, end) - 1
+            if idx >= 0 and boundaries[idx] > start + overlap:
+                end = boundaries[idx]
+        yield {"source_type": source_type, "window": window, "text": text[offsets[start][0]:offsets[end - 1][1]].strip()}
+        if end == len(offsets):
+            return
+        start, window = max(end - overlap, start + 1), window + 1
+
+def pack_chunks(chunks, tokenizer, max_tokens=WINDOW_TOKENS, overlap=WINDOW_OVERLAP):
+    """
+    Split or merge the chunks of each document into windows under a token budget, so that long papers
+    are fully processed instead of being truncated or skipped on out of memory errors.
+    Chunks of a document must be contiguous in the stream (as produced by combine_chunks or process_text_files).
+
+    @params:
+        - chunks: iterable of chunks with source_type and text
+        - tokenizer: the tokenizer of the extraction model
+        - max_tokens: token budget of a window
+        - overlap: number of tokens of a window repeated at the start of the next one
 
+    @returns:
+        - a generator of windows with source_type, window and text
+    """
+    for doc_id, items in groupby(chunks, key=lambda item: item['source_type']):
+        yield from pack_document(doc_id, [item['text'] for item in items], tokenizer, max_tokens, overlap)
@@ -0,0 +1,100 @@
+# general import
+import re
+import pandas as pd
+import pycountry
+
+# years as whole numbers only, "2010" does not match inside "120105" or "2010345"
+YEAR_PATTERN = re.compile(r'(?<!\d)(1[0-9]\d{2}|20\d{2})(?!\d)')
+SPECIES_KEYWORDS = ["aegypti", "albopictus"]
+SPECIES_PATTERN = re.compile("|".join(SPECIES_KEYWORDS), re.IGNORECASE)
+
+
+def country_vocabulary(countries=()):
+    """
+    Country names looked for in the texts: the pycountry names and the given ones (e.g. the countries of the output)
+    """
+    names = set()
+    for country in pycountry.countries:
+        names.update(getattr(country, attr) for attr in ("name", "official_name", "common_name") if hasattr(country, attr))
+    names.update(str(country) for country in countries if isinstance(country, str) and country.strip())
+    return names
+
+def compile_country_pattern(names):
+    # zero width lookahead, a match is tried at every position so that nested names ("Congo" in
+    # "Democratic Republic of the Congo") are found too; longest names first at a given position
+    alternatives = sorted((re.escape(name.strip()) for name in names), key=len, reverse=True)
+    return re.compile(r'(?=(?<!\w)(' + "|".join(alternatives) + r')(?!\w))')
+
+def country_prefixes(names):
+    """
+    For each name, the other names it starts with on a word boundary ("United States" for "United States of America"),
+    the pattern only returns the longest name found at a position
+    """
+    names = sorted({name.strip() for name in names})
+    prefixes = {}
+    for name in names:
+        found = [other for other in names
+                 if len(other) < len(name) and name.startswith(other) and not (name[len(other)].isalnum() or name[len(other)] == "_")]
+        if found:
+            prefixes[name] = found
+    return prefixes
+
+def build_validation_index(sources, countries=()):
+    """
+    Pre-extract, once for the whole corpus, what validation checks in the source texts of each document
+
+    @params:
+        - sources: iterable of chunks with source_type and text (the input.jsonl records)
+        - countries: country names to look for besides the pycountry names, e.g. the country column of the output
+
+    @returns:
+        - a dictionary of three DataFrames, with one row per (source_type, value) found in the texts:
+          "years" (year), "countries" (country) and "species" (species keyword, lower case)
+    """
+    vocabulary = country_vocabulary(countries)
+    country_pattern = compile_country_pattern(vocabulary)
+    prefixes = country_prefixes(vocabulary)
+    years, mentions, species = set(), set(), set()
+    for item in sources:
+        source_type, text = str(item["source_type"]), item["text"]
+        years.update((source_type, int(year)) for year in YEAR_PATTERN.findall(text))
+        for country in set(country_pattern.findall(text)):
+            mentions.add((source_type, country))
+            mentions.update((source_type, prefix) for prefix in prefixes.get(country, ()))
+        species.update((source_type, keyword.lower()) for keyword in SPECIES_PATTERN.findall(text))
+    return {
+        "years": pd.DataFrame(sorted(years), columns=["source_type", "year"]),
+        "countries": pd.DataFrame(sorted(mentions), columns=["source_type", "country"]),
+        "species": pd.DataFrame(sorted(species), columns=["source_type", "species"]),
+    }
+
+def is_in_index(keys, table):
+    """
+    Vectorized membership of (source_type, value) pairs in one of the index tables
+    """
+    return pd.MultiIndex.from_frame(keys).isin(pd.MultiIndex.from_frame(table))
+
+def validate_occurrences(df, index, species=None):
+    """
+    Keep-mask of the occurrences whose year, country and species are all mentioned in the texts of their document.
+    A year of 0 (unknown, see process_year_column) is not checked.
+
+    @params:
+        - df: occurrences with source_type, year, country and vector columns
+        - index: the index returned by build_validation_index
+        - species: species keyword checked for every row (e.g. "aegypti"), taken from the vector column if None
+
+    @returns:
+        - a boolean Series aligned with df
+    """
+    source_type = df["source_type"].astype(str)
+    year = pd.to_numeric(df["year"], errors="coerce").fillna(0).astype(int)
+    if species is None:
+        keyword = df["vector"].astype(str).str.split().str[-1].str.lower()
+    else:
+        keyword = pd.Series(species.lower(), index=df.index)
+
+    year_ok = is_in_index(pd.DataFrame({"source_type": source_type, "year": year}), index["years"]) | (year == 0).to_numpy()
+    country_ok = is_in_index(pd.DataFrame({"source_type": source_type, "country": df["country"].astype(str)}), index["countries"])
+    species_ok = is_in_index(pd.DataFrame({"source_type": source_type, "species": keyword}), index["species"])
+    return pd.Series(year_ok & country_ok & species_ok, index=df.index)
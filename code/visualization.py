@@ -1,11 +1,25 @@
 #### imports #####
 
+import os
+import sys
+import time
 import pandas as pd
-import pycountry_convert as pc
 import cartopy.crs as ccrs
 import matplotlib.pyplot as plt
 import numpy as np
 import cartopy.feature as cfeature
+from country_utilities import continent_column
+
+BASEMAP_CACHE = "basemap_cache"     # folder of the rendered basemaps, one PNG per width
+BASEMAP_WIDTH = 3600                # pixels, 12 inches at 300 dpi
+GLOBAL_EXTENT = (-180, 180, -90, 90)
+DPI = 300
+# (smallest size, largest size, color) of the occurrence markers, size = occurrences * 20
+SIZE_CLASSES = [(0, 40, 'purple'), (40, 200, 'blue'), (200, np.inf, 'darkblue')]
+SPECIES = ["aegypti", "albopictus"]
+VARIANTS = {"gt": "validation_{}.csv", "pred": "output_{}.csv", "updated": "updated_{}.csv"}
+
+_basemaps = {}
 
 
 def normalize_dataset(dataset):
@@ -19,54 +33,109 @@ def normalize_dataset(dataset):
     dataset["y"] = dataset["y"].astype(float)
     dataset["x"] = dataset["x"].astype(float)
 
-    def country_to_continent(country_name):
-        try:
-            country_code = pc.country_name_to_country_alpha2(country_name)
-            continent_code = pc.country_alpha2_to_continent_code(country_code)
-            return {
-                'AF': 'Africa',
-                'AS': 'Asia',
-                'EU': 'Europe',
-                'NA': 'North America',
-                'SA': 'South America',
-                'OC': 'Oceania',
-                'AN': 'Antarctica'
-            }[continent_code]
-        except:
-            return 'Unknown'
-    
-    dataset['region'] = dataset['country'].apply(country_to_continent)
-
-
-def world_map(dataset,title="",species="",save_to_file=None):
-    plt.figure(figsize=(12, 6))
-    ax = plt.axes(projection=ccrs.PlateCarree())
-    ax.set_facecolor('white')  
-    ax.add_feature(cfeature.LAND, facecolor='#D3D3D3', edgecolor='none')  
-    ax.add_feature(cfeature.BORDERS, linewidth=0.5, edgecolor='black')  
-    ax.coastlines(color='black', linewidth=0.5)  
+    dataset['region'] = continent_column(dataset['country'])
+
+
+def render_basemap(path, width=BASEMAP_WIDTH):
+    # the only Cartopy rendering: land, borders and coastlines of the whole globe in PlateCarree, without margins
+    fig = plt.figure(figsize=(width / 100, width / 200), dpi=100, facecolor='white')
+    ax = fig.add_axes([0, 0, 1, 1], projection=ccrs.PlateCarree())
+    ax.set_facecolor('white')
+    ax.add_feature(cfeature.LAND, facecolor='#D3D3D3', edgecolor='none')
+    ax.add_feature(cfeature.BORDERS, linewidth=0.5, edgecolor='black')
+    ax.coastlines(color='black', linewidth=0.5)
     ax.set_global()
-    ax.scatter(dataset["x"], dataset["y"], transform=ccrs.PlateCarree(), color='red', s=10, alpha=0.6)
-    plt.title(title)
+    ax.spines['geo'].set_visible(False)
+    fig.savefig(path, dpi=100, facecolor='white')
+    plt.close(fig)
+
+def basemap_image(width=BASEMAP_WIDTH, cache_folder=BASEMAP_CACHE):
+    """
+    Projected basemap as an image array, rendered with Cartopy once and then read from the cache folder
+
+    @params:
+        - width: width of the image in pixels, the height is half of it
+        - cache_folder: folder of the cached PNG files
+
+    @returns:
+        - the RGBA image array
+    """
+    if width not in _basemaps:
+        path = os.path.join(cache_folder, f"basemap_{width}.png")
+        if not os.path.exists(path):
+            os.makedirs(cache_folder, exist_ok=True)
+            render_basemap(path, width)
+        _basemaps[width] = plt.imread(path)
+    return _basemaps[width]
+
+def draw_basemap(ax, width=BASEMAP_WIDTH):
+    # PlateCarree coordinates are the longitude and latitude, the points are drawn on a plain axes over the image
+    ax.imshow(basemap_image(width), extent=GLOBAL_EXTENT, origin='upper', interpolation='antialiased', zorder=0)
+    ax.set_xlim(GLOBAL_EXTENT[:2])
+    ax.set_ylim(GLOBAL_EXTENT[2:])
+    ax.set_aspect('equal')
+    ax.set_xticks([])
+    ax.set_yticks([])
+
+def draw_occurrences(ax, dataset):
+    ax.scatter(dataset["x"].to_numpy(float), dataset["y"].to_numpy(float), color='red', s=10, alpha=0.6, zorder=1)
+
+def save_figure(fig, save_to_file, show, dpi=DPI):
+    if save_to_file:
+        fig.savefig(save_to_file, bbox_inches='tight', dpi=dpi)
+    if show:
+        plt.show()
+    else:
+        plt.close(fig)
+
+def world_map(dataset,title="",species="",save_to_file=None,show=True,dpi=DPI):
+    fig, ax = plt.subplots(figsize=(12, 6))
+    draw_basemap(ax)
+    draw_occurrences(ax, dataset)
+    ax.set_title(title)
     ax.text(0.02, -0.05,species, transform=ax.transAxes, fontsize=10)
-    plt.savefig(save_to_file, bbox_inches='tight', dpi=300)
-    plt.show()
+    save_figure(fig, save_to_file, show, dpi)
+
+def comparison_map(datasets,titles=("Ground Truth", "Pipeline extraction"),save_to_file=None,show=True,dpi=DPI):
+    """
+    Maps of several datasets side by side on the cached basemap
+
+    @params:
+        - datasets: list of normalized datasets
+        - titles: title of each map
+        - save_to_file: output file, not saved if None
+        - show: display the figure, it is closed otherwise
+        - dpi: resolution of the saved figure
+    """
+    fig, axs = plt.subplots(1, len(datasets), figsize=(12 * len(datasets), 6), squeeze=False)
+    for ax, dataset, title in zip(axs[0], datasets, titles):
+        draw_basemap(ax)
+        draw_occurrences(ax, dataset)
+        ax.set_title(title, fontsize=24, fontweight='bold', family='serif')
+    plt.tight_layout()
+    save_figure(fig, save_to_file, show, dpi)
 
-def plot_evolution_yearly(dataset,save_to_file=None):
+def plot_evolution_yearly(dataset,save_to_file=None,show=True,dpi=DPI):
     grouped = dataset.groupby(['year', 'region', 'country']).size().reset_index(name='occurrences')
+    plot_yearly_counts(grouped, save_to_file, show, dpi)
 
+def plot_yearly_counts(grouped,save_to_file=None,show=True,dpi=DPI):
+    # grouped: occurrences by year, region and country, from a dataset or from occurrence_cube.yearly_counts
     fig, axs = plt.subplots(2, 2, figsize=(12, 8), sharex=True)
     axs = axs.ravel()
 
     for idx, region in enumerate(grouped['region'].unique()[:4]):
         region_data = grouped[grouped['region'] == region]
-        countries = region_data['country'].unique()
-        country_map = {c: i for i, c in enumerate(countries)}
-        for _, row in region_data.iterrows():
-            y = country_map[row['country']] + np.random.uniform(-0.3, 0.3)
-            size = row['occurrences'] * 20
-            color = 'purple' if size < 40 else 'blue' if size < 200 else 'darkblue'
-            axs[idx].scatter(row['year'], y, s=size, alpha=0.6, c=color)
+        # country rows in order of appearance, jittered vertically
+        country_idx, countries = pd.factorize(region_data['country'])
+        y = country_idx + np.random.uniform(-0.3, 0.3, len(region_data))
+        year = region_data['year'].to_numpy()
+        size = region_data['occurrences'].to_numpy() * 20
+        # one scatter per size class instead of one per row
+        for low, high, color in SIZE_CLASSES:
+            mask = (size >= low) & (size < high)
+            if mask.any():
+                axs[idx].scatter(year[mask], y[mask], s=size[mask], alpha=0.6, c=color)
         axs[idx].set_yticks(range(len(countries)))
         axs[idx].set_yticklabels(countries)
         axs[idx].set_title(region)
@@ -82,5 +151,43 @@ def plot_evolution_yearly(dataset,save_to_file=None):
     fig.legend(handles=legend_elements, loc='center', bbox_to_anchor=(0.55, 0.55),markerscale=0.7)
 
     plt.tight_layout()
-    plt.savefig(save_to_file, dpi=300, bbox_inches='tight')
-    plt.show()
\ No newline at end of file
+    save_figure(fig, save_to_file, show, dpi)
+
+def render_all(data_folder="../data",output_folder="../visualization",species=SPECIES,dpi=DPI,folders=None,compare=("gt", "pred")):
+    """
+    Headless rendering of the whole figure set: the temporal plot of each species and variant
+    (gt: validation_*.csv, pred: output_*.csv, updated: updated_*.csv) and the ground truth / pipeline
+    comparison map of each species. Missing files are skipped.
+
+    @params:
+        - data_folder: folder of the CSV files
+        - output_folder: folder of the PNG files
+        - species: species names used in the file names
+        - dpi: resolution of the saved figures
+        - folders: folder of some of the variants, e.g. {"gt": "../data"}, data_folder for the others
+        - compare: the two variants of the comparison map
+    """
+    plt.switch_backend("Agg")
+    os.makedirs(output_folder, exist_ok=True)
+    start = time.time()
+    count = 0
+    for name in species:
+        datasets = {}
+        for variant, pattern in VARIANTS.items():
+            path = os.path.join((folders or {}).get(variant, data_folder), pattern.format(name))
+            if not os.path.exists(path):
+                print(f"{path} not found, skipped")
+                continue
+            datasets[variant] = pd.read_csv(path)
+            normalize_dataset(datasets[variant])
+            plot_evolution_yearly(datasets[variant], os.path.join(output_folder, f"temporal_{name}_{variant}.png"), show=False, dpi=dpi)
+            count += 1
+        if all(variant in datasets for variant in compare):
+            comparison_map([datasets[variant] for variant in compare], save_to_file=os.path.join(output_folder, f"{name}_comparison.png"),
+                           show=False, dpi=dpi)
+            count += 1
+    print(f"{count} figures rendered in {time.time() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    render_all(*sys.argv[1:3])